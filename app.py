@@ -7,13 +7,22 @@ from dotenv import dotenv_values
 from functools import wraps
 import ml.knn as knn
 import ml.tfidf as tfidf
+import ml.shards as shards
 from urllib.parse import unquote
 
 app = Flask(__name__)
 CORS(app)
 SECRETS = dotenv_values(".env")
-KNN_NEIGHBORS = knn.kNearestNeighbors()
 KNN_DATA = knn.read_data()
+KNN_NEIGHBORS = knn.kNearestNeighbors(KNN_DATA)
+KNN_ITEMS = knn.read_items(KNN_DATA)
+KNN_FACTORS = knn.read_factors(KNN_DATA)
+MAX_BATCH_SIZE = 50
+MAX_PAGE_SIZE = 100
+RANKERS = {"tfidf": "cosine_search", "bm25": "bm25_search", "ann": "ann_search"}
+SHARDED_INDEX = shards.ShardedIndex() if shards.SHARDED else None
+DEFAULT_RADIUS = 2000
+MAX_RADIUS = 50000
 
 def api_key_required(f):
     """
@@ -34,6 +43,123 @@ def api_key_required(f):
     return decorated
 
 
+def get_page(values: dict) -> tuple:
+    """Gets the page of results requested
+    Args:
+        values (dict): The arguments or body of the request, k and offset are optional
+    Returns:
+        tuple: The number of results (k) and the number of results to skip (offset)
+    Raises:
+        ValueError: If k or offset are not valid
+    """
+    try:
+        k = int(values.get("k", 10))
+        offset = int(values.get("offset", 0))
+    except (ValueError, TypeError):
+        raise ValueError("k and offset need to be integers")
+    
+    if not 0 < k <= MAX_PAGE_SIZE or offset < 0:
+        raise ValueError(f"k needs to be between 1 and {MAX_PAGE_SIZE} and offset can not be negative")
+    
+    return k, offset
+
+
+def get_bm25_parameters(values: dict) -> dict:
+    """Gets the BM25F parameters requested
+    Args:
+        values (dict): The arguments of the request, k1, b, name_boost and description_boost are optional
+    Returns:
+        dict: The keyword arguments for tfidf.bm25_search
+    Raises:
+        ValueError: If some parameter is not valid
+    """
+    try:
+        k1 = float(values.get("k1", tfidf.BM25_K1))
+        b = float(values.get("b", tfidf.BM25_B))
+        boosts = {field: float(values.get(f"{field}_boost", boost)) for field, boost in tfidf.BM25_BOOSTS.items()}
+    except (ValueError, TypeError):
+        raise ValueError("k1, b, name_boost and description_boost need to be numbers")
+    
+    if not 0 <= k1 < float("inf") or not 0 <= b <= 1 or not all(0 <= boost < float("inf") for boost in boosts.values()):
+        raise ValueError("k1 and the boosts can not be negative and b needs to be between 0 and 1")
+    
+    return {"k1": k1, "b": b, "boosts": boosts}
+
+
+def get_location(values: dict) -> tuple or None:
+    """Gets the location and radius requested
+    Args:
+        values (dict): The arguments of the request, lat and lng go together and radius (in meters) is optional
+    Returns:
+        tuple: The latitude, longitude and radius
+        None: If no location was requested
+    Raises:
+        ValueError: If the location or the radius are not valid
+    """
+    if "lat" not in values and "lng" not in values:
+        return None
+    
+    try:
+        latitude = float(values["lat"])
+        longitude = float(values["lng"])
+        radius = float(values.get("radius", DEFAULT_RADIUS))
+    except (KeyError, ValueError, TypeError):
+        raise ValueError("lat and lng need to be numbers, as well as radius")
+    
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180 or not 0 < radius <= MAX_RADIUS:
+        raise ValueError(f"lat needs to be between -90 and 90, lng between -180 and 180 and radius between 0 and {MAX_RADIUS} meters")
+    
+    return latitude, longitude, radius
+
+
+def get_facets(values) -> dict:
+    """Gets the facet filters requested
+    Args:
+        values (MultiDict): The arguments of the request, category and price can be sent many times and public once, all are optional
+    Returns:
+        dict: The values allowed of each facet requested
+    Raises:
+        ValueError: If some value is not valid
+    """
+    facets = {}
+    
+    if "category" in values:
+        facets["category"] = values.getlist("category")
+    
+    if "price" in values:
+        try:
+            facets["price"] = [int(price) for price in values.getlist("price")]
+        except ValueError:
+            raise ValueError("price needs to be an integer")
+    
+    if "public" in values:
+        if values["public"] not in ("true", "false"):
+            raise ValueError("public needs to be true or false")
+        facets["public"] = [values["public"] == "true"]
+    
+    return facets
+
+
+def get_probes(values: dict) -> int:
+    """Gets the number of groups of places scored on approximate search
+    Args:
+        values (dict): The arguments of the request, probes is optional
+    Returns:
+        int: The number of groups
+    Raises:
+        ValueError: If probes is not valid
+    """
+    try:
+        probes = int(values.get("probes", tfidf.ANN_PROBES))
+    except (ValueError, TypeError):
+        raise ValueError("probes needs to be an integer")
+    
+    if probes < 1:
+        raise ValueError("probes needs to be at least 1")
+    
+    return probes
+
+
 @app.errorhandler(404)
 def resource_not_found(e):
     """Page not found
@@ -85,30 +211,101 @@ def notify():
     return jsonify({"status": "ok"}), 200
 
 
+@app.route('/index', methods=['GET', 'DELETE'])
+@api_key_required
+def index_place():
+    """
+    Adds or updates the place sent on the search index, or removes it from the index if the method is DELETE
+    """
+    try:
+        placeId = request.args["place"]
+    except KeyError:
+        return "Place needs to be on request", 400
+    
+    # When the index is sharded, the place is sent to its shard (and to the whole index only if it was loaded)
+    if request.method == 'DELETE':
+        if SHARDED_INDEX is not None:
+            found = SHARDED_INDEX.remove_place(objectId=placeId)
+        if tfidf.index_loaded():
+            found = tfidf.remove_place(objectId=placeId)
+        return jsonify({"status": "ok", "found": found}), 200
+    
+    # Get place from Parse and index only that place
+    place = parse_server.get_place(objectId=placeId)
+    location = {"latitude": place.location.latitude, "longitude": place.location.longitude}
+    category = place.category.objectId if place.category is not None else None
+    place = {
+        "id": place.objectId,
+        "name": place.name,
+        "description": place.description,
+        "likeCount": place.likeCount,
+        "location": location,
+        "category": category,
+        "price": place.price,
+        "public": place.public
+        }
+    if SHARDED_INDEX is not None:
+        SHARDED_INDEX.upsert_place(place=place)
+    if tfidf.index_loaded():
+        tfidf.upsert_place(place=place)
+    
+    return jsonify({"status": "ok"}), 200
+
+
 @app.route('/recommend', methods=['GET'])
 @api_key_required
 def topK():
     """
-    Gets 5 places (or less) to recommend to a specific user
+    Gets 5 places (or less) to recommend to a specific user, by similar users, by places similar to the ones it liked
+    or by matrix factorization
     """
-    global KNN_NEIGHBORS, KNN_DATA
+    global KNN_NEIGHBORS, KNN_DATA, KNN_ITEMS, KNN_FACTORS
     
     try:
         userId = request.args["user"]
     except KeyError:
         return "User not found on the request", 400
     
+    method = request.args.get("method", "users")
+    if method not in knn.METHODS:
+        return f"method needs to be one of {', '.join(knn.METHODS)}", 400
+    
     # Get the list of 5 recommendations for the user
-    places = knn.recommend(neighbors=KNN_NEIGHBORS, data=KNN_DATA, user=userId)
+    if method == "items":
+        places = knn.recommend_items(items=KNN_ITEMS, data=KNN_DATA, user=userId)
+    elif method == "als":
+        places = knn.recommend_factors(factors=KNN_FACTORS, data=KNN_DATA, user=userId)
+    else:
+        places = knn.recommend(neighbors=KNN_NEIGHBORS, data=KNN_DATA, user=userId)
     
     return jsonify({"places": places}), 200
 
 
+@app.route('/like', methods=['GET', 'DELETE'])
+@api_key_required
+def like_place():
+    """
+    Adds the like of a user on a place to the recommendations, or removes it if the method is DELETE
+    """
+    global KNN_NEIGHBORS, KNN_DATA
+    
+    try:
+        userId = request.args["user"]
+        placeId = request.args["place"]
+    except KeyError:
+        return "User and place need to be on request", 400
+    
+    # Update the likes of the user and the neighbors of the users affected only
+    changed = knn.like(neighbors=KNN_NEIGHBORS, data=KNN_DATA, user=userId, place=placeId, liked=request.method != 'DELETE')
+    
+    return jsonify({"status": "ok", "changed": changed}), 200
+
+
 @app.route('/search', methods=['GET'])
 @api_key_required
 def search_places():
     """
-    Get top 10 places for search using tf-idf algorithm
+    Get top places for search using tf-idf algorithm (or BM25F if requested), 10 by default or the page requested with k and offset
     """
     
     try:
@@ -116,10 +313,138 @@ def search_places():
     except KeyError:
         return "Query not found", 400
     
-    # Get top places for query using cosine similarity
-    places = tfidf.cosine_search(query=query)
+    ranker = request.args.get("ranker", "tfidf")
+    if ranker not in RANKERS:
+        return f"ranker needs to be one of {', '.join(RANKERS)}", 400
     
-    return jsonify({"places": places}), 200
+    try:
+        k, offset = get_page(request.args)
+        location = get_location(request.args)
+        facets = get_facets(request.args)
+        # BM25F over the name and description, cosine similarity only on the places closest to the query (ann),
+        # or cosine similarity on all places (tfidf)
+        parameters = {}
+        if ranker == "bm25":
+            parameters = get_bm25_parameters(request.args)
+        elif ranker == "ann":
+            parameters = {"probes": get_probes(request.args)}
+    except ValueError as e:
+        return str(e), 400
+    
+    # Only places near the location sent and with the facet values sent are returned, if any
+    filters = {"location": location, **facets}
+    
+    if SHARDED_INDEX is not None:
+        # Search all shards at once and merge their top places
+        places, scores, facets = SHARDED_INDEX.search(RANKERS[ranker], query=query, k=k, offset=offset, filters=filters, **parameters)
+    else:
+        search = getattr(tfidf, RANKERS[ranker])
+        places, scores, facets = search(query=query, k=k, offset=offset, filters=filters, with_scores=True, with_facets=True, **parameters)
+    
+    return jsonify({"places": places, "scores": scores, "facets": facets}), 200
+
+
+@app.route('/search/batch', methods=['POST'])
+@api_key_required
+def batch_search_places():
+    """
+    Get top places for each one of many searches at once, the queries are sent as a JSON list on the body
+    """
+    
+    body = request.get_json(silent=True) or {}
+    queries = body.get("queries", None)
+    
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return "Queries not found", 400
+    if len(queries) > MAX_BATCH_SIZE:
+        return f"At most {MAX_BATCH_SIZE} queries can be sent at once", 400
+    
+    try:
+        k, offset = get_page(body)
+    except ValueError as e:
+        return str(e), 400
+    
+    # Get top places for all queries using cosine similarity, on all shards at once if the index is sharded
+    if SHARDED_INDEX is not None:
+        results = SHARDED_INDEX.batch_search(queries=queries, k=k, offset=offset)
+    else:
+        results = tfidf.batch_cosine_search(queries=queries, k=k, offset=offset, with_scores=True)
+    
+    return jsonify({"places": [x[0] for x in results], "scores": [x[1] for x in results]}), 200
+
+
+@app.route('/nearby', methods=['GET'])
+@api_key_required
+def nearby():
+    """
+    Get the places closest to a location within a radius, 10 by default or the page requested with k and offset
+    """
+    
+    try:
+        location = get_location(request.args)
+        k, offset = get_page(request.args)
+    except ValueError as e:
+        return str(e), 400
+    
+    if location is None:
+        return "Location not found", 400
+    
+    # Get closest places using the grid index, without comparing places outside of the radius
+    if SHARDED_INDEX is not None:
+        places, distances = SHARDED_INDEX.nearby(*location, k=k, offset=offset)
+    else:
+        places, distances = tfidf.nearby(*location, k=k, offset=offset)
+    
+    return jsonify({"places": places, "distances": distances}), 200
+
+
+@app.route('/similar', methods=['GET'])
+@api_key_required
+def similar():
+    """
+    Get the places most similar in content to a place, 10 by default
+    """
+    
+    try:
+        placeId = request.args["place"]
+    except KeyError:
+        return "Place not found", 400
+    
+    try:
+        k = int(request.args.get("k", 10))
+    except ValueError:
+        return "k needs to be an integer", 400
+    
+    if not 0 < k <= tfidf.SIMILAR_SIZE:
+        return f"k needs to be between 1 and {tfidf.SIMILAR_SIZE}", 400
+    
+    # Get the neighbors of the place precomputed when the index was built (the whole index, even if it is sharded)
+    tfidf.open_index()
+    try:
+        places, scores = tfidf.similar(objectId=placeId, k=k)
+    except KeyError:
+        return jsonify({"message": "place is not on the search index"}), 404
+    
+    return jsonify({"places": places, "scores": scores}), 200
+
+
+@app.route('/suggest', methods=['GET'])
+@api_key_required
+def suggest():
+    """
+    Get typeahead suggestions of words and places for what the user has typed so far
+    """
+    
+    try:
+        prefix = unquote(request.args["prefix"])
+    except KeyError:
+        return "Prefix not found", 400
+    
+    # Get words and places that start like the prefix, without running a search (on the whole index, even if it is sharded)
+    tfidf.open_index()
+    suggestions = tfidf.suggest(prefix=prefix)
+    
+    return jsonify(suggestions), 200
 
 
 @app.route('/promote', methods=['GET'])
@@ -145,4 +470,7 @@ def promote_place():
 
 
 if __name__ == '__main__':
+    # Shard servers are started once here when running a single process, otherwise they run on their own (python -m ml.shards)
+    if shards.SHARDED and not shards.SHARD_ADDRESSES:
+        shards.start_servers()
     app.run(debug=False, host='0.0.0.0', port=int(SECRETS.get("PORT")))
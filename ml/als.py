@@ -0,0 +1,204 @@
+"""
+Matrix factorization of the likes with implicit ALS (alternating least squares). Each user and each place gets a
+    vector of a few factors, so that the dot product of a user and a place is close to 1 where the user liked the
+    place and close to 0 elsewhere, likes weighing alpha times more than the places not liked. Users and places are
+    solved in turns, each one a small linear system solved with a few steps of conjugate gradient, for a chunk of
+    users (or places) at a time with sparse products.
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+# Factors saved by save, bump FACTORS_VERSION whenever their format changes
+FACTORS_VERSION = 1
+
+# Maximum number of values of the factors of the places liked on a chunk of users (or places) solved at a time
+CHUNK_SIZE = 2 ** 22
+
+
+def chunks(indptr: np.array, size: int) -> list:
+    """Splits the rows of a matrix in chunks of contiguous rows with about size likes and no more than size rows
+
+    Args:
+        indptr (np.array): Where the likes of each row start and end
+        size (int): The size of the chunks
+
+    Returns:
+        list: The first and last (not included) row of each chunk
+    """
+    n_rows = len(indptr) - 1
+    keys = np.asarray(indptr[:-1]) // size + np.arange(n_rows) // size
+    starts = np.flatnonzero(np.diff(keys, prepend=-1))
+    return list(zip(starts, np.append(starts[1:], n_rows)))
+
+
+def solve(matrix: sparse.csr_matrix, other: np.array, start: np.array, regularization: float, alpha: float, steps: int, threads: int) -> np.array:
+    """Solves the factors of each row of the likes given the factors of the columns. For each row
+        (YᵀY + alpha YₗᵀYₗ + regularization I) x = (1 + alpha) Yₗᵀ1, where Yₗ are the factors of the columns liked,
+        with a few steps of conjugate gradient from the factors it had, done for all rows of a chunk at once with
+        sparse products so no f×f matrix is made for each row
+
+    Args:
+        matrix (sparse.csr_matrix): The likes (1 where liked)
+        other (np.array): The factors of each column (rows)
+        start (np.array): The factors each row had (rows)
+        regularization (float): The weight of the norm of the factors
+        alpha (float): How much more a like weighs than a place not liked
+        steps (int): The number of steps of conjugate gradient, as many as factors solves exactly
+        threads (int): The number of chunks solved at the same time
+
+    Returns:
+        np.array: The factors of each row (rows)
+    """
+    n_factors = other.shape[1]
+    gram = (other.T @ other + regularization * np.eye(n_factors)).astype(np.float32)
+    result = np.array(start, dtype=np.float32)
+
+    def solve_chunk(chunk: tuple) -> None:
+        first, last = chunk
+        likes = matrix[first:last]
+        rows = np.repeat(np.arange(last - first), np.diff(likes.indptr))
+        liked = other[likes.indices]
+
+        def product(x: np.array) -> np.array:
+            dots = np.einsum("ij,ij->i", liked, x[rows])
+            return x @ gram + alpha * (sparse.csr_matrix((dots, likes.indices, likes.indptr), shape=likes.shape) @ other)
+
+        x = result[first:last]
+        residual = (1 + alpha) * (likes @ other) - product(x)
+        direction = residual.copy()
+        norms = np.einsum("ij,ij->i", residual, residual)
+
+        for _ in range(steps):
+            projected = product(direction)
+            curvature = np.einsum("ij,ij->i", direction, projected)
+            step = np.divide(norms, curvature, out=np.zeros_like(norms), where=curvature > 0)
+            x += step[:, None] * direction
+            residual -= step[:, None] * projected
+            new_norms = np.einsum("ij,ij->i", residual, residual)
+            direction = residual + np.divide(new_norms, norms, out=np.zeros_like(norms), where=norms > 0)[:, None] * direction
+            norms = new_norms
+
+        result[first:last] = x
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(solve_chunk, chunks(matrix.indptr, max(1, CHUNK_SIZE // n_factors))))
+
+    return result
+
+
+class Factors:
+    """Factors of each user and each place, with what is needed to get the factors of a user that was not trained
+    """
+
+    def __init__(self, users: np.array, items: np.array, regularization: float, alpha: float) -> None:
+        """Creates the factors out of their arrays, as made by train
+
+        Args:
+            users (np.array): The factors of each user (rows, float32)
+            items (np.array): The factors of each place (rows, float32)
+            regularization (float): The weight of the norm of the factors they were trained with
+            alpha (float): How much more a like weighs than a place not liked
+        """
+        self.users = users
+        self.items = items
+        self.regularization = regularization
+        self.alpha = alpha
+        self.gram = items.T.astype(np.float64) @ items + regularization * np.eye(items.shape[1])
+
+    @classmethod
+    def train(cls, matrix: sparse.csr_matrix, n_factors: int, iterations: int, regularization: float, alpha: float, threads: int, seed: int, steps: int = 3) -> "Factors":
+        """Trains the factors of users and places on the likes
+
+        Args:
+            matrix (sparse.csr_matrix): The likes of each user (rows) on each place (columns)
+            n_factors (int): The number of factors
+            iterations (int): The number of times users and places are solved
+            regularization (float): The weight of the norm of the factors
+            alpha (float): How much more a like weighs than a place not liked
+            threads (int): The number of chunks solved at the same time
+            seed (int): The seed of the random generator
+            steps (int): The number of steps of conjugate gradient of each solve
+
+        Returns:
+            Factors: The factors
+        """
+        rand = np.random.default_rng(seed)
+        matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+        columns = matrix.T.tocsr()
+
+        items = (rand.standard_normal((matrix.shape[1], n_factors)) * 0.01).astype(np.float32)
+        users = np.zeros((matrix.shape[0], n_factors), dtype=np.float32)
+        for _ in range(iterations):
+            users = solve(matrix, items, users, regularization, alpha, steps, threads)
+            items = solve(columns, users, items, regularization, alpha, steps, threads)
+
+        return cls(users, items, regularization, alpha)
+
+    def fold_in(self, liked: np.array) -> np.array:
+        """Gets the factors of a user that was not trained from its likes, keeping the places fixed
+
+        Args:
+            liked (np.array): The places (columns) liked by the user, places not trained are left out
+
+        Returns:
+            np.array: The factors of the user
+        """
+        liked = self.items[liked[liked < len(self.items)]].astype(np.float64)
+        return np.linalg.solve(self.gram + self.alpha * liked.T @ liked, (1 + self.alpha) * liked.sum(axis=0)).astype(np.float32)
+
+    def save(self, path: str, users: list, places: list) -> None:
+        """Saves the factors into a directory, as raw .npy arrays plus a .json file with the users and places
+
+        Args:
+            path (str): The directory where the factors are saved
+            users (list): The objectId of the user of each row
+            places (list): The objectId of the place of each row
+        """
+        os.makedirs(path, exist_ok=True)
+
+        np.save(os.path.join(path, "users.npy"), self.users)
+        np.save(os.path.join(path, "items.npy"), self.items)
+
+        # Metadata is written last so half written factors are never loaded
+        with open(os.path.join(path, "factors.json"), "w") as file:
+            json.dump({
+                "version": FACTORS_VERSION,
+                "regularization": self.regularization,
+                "alpha": self.alpha,
+                "users": users[:len(self.users)],
+                "places": places[:len(self.items)]
+                }, file)
+
+    @classmethod
+    def load(cls, path: str, users: list, places: list) -> "Factors":
+        """Loads factors saved with save, their arrays memory-mapped read only
+
+        Args:
+            path (str): The directory where the factors were saved
+            users (list): The objectId of the user of each row now
+            places (list): The objectId of the place of each column now
+
+        Returns:
+            Factors: The factors
+
+        Raises:
+            FileNotFoundError: if there are no factors saved on that directory
+            ValueError: if the factors saved were trained by another version or on other users or places
+        """
+        with open(os.path.join(path, "factors.json")) as file:
+            meta = json.load(file)
+
+        if meta.get("version") != FACTORS_VERSION:
+            raise ValueError(f"Factors version {meta.get('version')} is not supported, train them again")
+        if meta["users"] != users[:len(meta["users"])] or meta["places"] != places[:len(meta["places"])]:
+            raise ValueError("Factors were trained on other users or places, train them again")
+
+        def load(name: str) -> np.array:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        return cls(load("users"), load("items"), meta["regularization"], meta["alpha"])
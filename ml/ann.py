@@ -0,0 +1,145 @@
+"""
+Inverted file index (IVF) used for approximate search on large catalogs. Places are reduced to a few dimensions
+    with a random projection and grouped around centroids found with k-means, so a query only needs to score the
+    places of the groups whose centroids are closest to it. The more groups are probed, the closer to exact search.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+def random_projection(n_terms: int, dimensions: int, seed: int, start: int = 0) -> np.array:
+    """Creates the random projection of some words to a few dimensions
+
+    Args:
+        n_terms (int): The number of words (rows of the projection) up to the last one
+        dimensions (int): The number of dimensions
+        seed (int): The seed of the random generator
+        start (int): The first word, to extend a projection of the words before it
+
+    Returns:
+        np.array: The projection of each word from start up to n_terms (rows)
+    """
+    rand = np.random.default_rng([seed, start])
+    return (rand.standard_normal((max(n_terms - start, 0), dimensions)) / np.sqrt(dimensions)).astype(np.float32)
+
+
+def normalize(vectors: np.array) -> np.array:
+    """Normalizes dense vectors (rows) to unit length, zero vectors are left as they are
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def kmeans(vectors: np.array, k: int, iterations: int, seed: int) -> np.array:
+    """Finds k centroids of unit vectors with spherical k-means (closest meaning highest dot product)
+
+    Args:
+        vectors (np.array): The unit vectors (rows)
+        k (int): The number of centroids
+        iterations (int): The number of iterations
+        seed (int): The seed of the random generator
+
+    Returns:
+        np.array: The unit centroids (rows)
+    """
+    rand = np.random.default_rng(seed)
+    centroids = vectors[rand.choice(len(vectors), size=k, replace=False)]
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # Centroids left without vectors start again from a random vector
+        empty = np.flatnonzero(np.bincount(assignments, minlength=k) == 0)
+        sums[empty] = vectors[rand.choice(len(vectors), size=len(empty))]
+        centroids = normalize(sums)
+
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Posting list of the places (their ids) closest to each centroid
+    """
+
+    def __init__(self, projection: np.array, centroids: np.array, indptr: np.array, ids: np.array) -> None:
+        """Creates the index out of its arrays, as made by train or assign
+
+        Args:
+            projection (np.array): The projection of each word to a few dimensions (rows)
+            centroids (np.array): The unit centroids on the reduced dimensions (rows)
+            indptr (np.array): Where the list of each centroid starts and ends on ids
+            ids (np.array): The ids of the places of each list, one list after the other
+        """
+        self.projection = projection
+        self.centroids = centroids
+        self.indptr = indptr
+        self.ids = ids
+
+    @classmethod
+    def train(cls, matrix: sparse.csr_matrix, n_lists: int, dimensions: int, iterations: int, sample_size: int, seed: int) -> "IVFIndex":
+        """Finds the centroids of a sample of the places and creates the index of all of them
+
+        Args:
+            matrix (sparse.csr_matrix): The vector of each place (rows)
+            n_lists (int): The number of centroids
+            dimensions (int): The number of dimensions of the random projection
+            iterations (int): The number of iterations of k-means
+            sample_size (int): The maximum number of places k-means is run on
+            seed (int): The seed of the random generators
+
+        Returns:
+            IVFIndex: The index
+        """
+        projection = random_projection(matrix.shape[1], dimensions, seed)
+        vectors = normalize(matrix @ projection)
+
+        n_lists = min(n_lists, len(vectors))
+        if n_lists == 0:
+            return cls(projection, np.zeros((0, dimensions), dtype=np.float32), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+        sample = np.random.default_rng(seed).choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)
+        centroids = kmeans(vectors[sample], n_lists, iterations, seed)
+        return cls(projection, centroids, None, None).assign(matrix, seed)
+
+    def assign(self, matrix: sparse.csr_matrix, seed: int) -> "IVFIndex":
+        """Creates the index of other places with the same centroids, new words are added to the projection
+
+        Args:
+            matrix (sparse.csr_matrix): The vector of each place (rows)
+            seed (int): The seed of the random generator of the projection of new words
+
+        Returns:
+            IVFIndex: The index
+        """
+        projection = self.projection
+        if matrix.shape[1] > len(projection):
+            projection = np.vstack((projection, random_projection(matrix.shape[1], projection.shape[1], seed, start=len(projection))))
+
+        if len(self.centroids) == 0:
+            return IVFIndex(projection, self.centroids, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+        assignments = np.argmax(normalize(matrix @ projection) @ self.centroids.T, axis=1)
+        ids = np.argsort(assignments, kind="stable")
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))))
+        return IVFIndex(projection, self.centroids, indptr.astype(np.int64), ids.astype(np.int64))
+
+    def candidates(self, vector: sparse.csr_matrix, probes: int) -> np.array:
+        """Gets the places on the lists of the centroids closest to a vector
+
+        Args:
+            vector (sparse.csr_matrix): The vector (a single row)
+            probes (int): The number of lists to get
+
+        Returns:
+            np.array: The ids of the places (sorted)
+        """
+        probes = min(probes, len(self.centroids))
+        if probes <= 0:
+            return np.zeros(0, dtype=np.int64)
+
+        reduced = (vector[:, :len(self.projection)] @ self.projection).ravel()
+        closest = np.argpartition(-(self.centroids @ reduced), probes - 1)[:probes]
+        return np.sort(np.concatenate([self.ids[self.indptr[x]:self.indptr[x + 1]] for x in closest]))
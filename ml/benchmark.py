@@ -0,0 +1,216 @@
+"""
+Benchmarks for the search engine. They are meant to be run from this folder, passing the name of the benchmark:
+
+    python benchmark.py analyzers
+    python benchmark.py ann
+    python benchmark.py neighbors
+"""
+
+import sys, os
+sys.path.append(os.path.abspath(os.path.join('..')))
+
+import random
+import time
+
+import numpy as np
+from scipy import sparse
+
+import tfidf
+import knn
+from ml.likes import Likes
+
+
+def sample_queries(n: int = 500, seed: int = 0) -> list:
+    """Creates queries out of the names and descriptions of the places
+
+    Args:
+        n (int): The number of queries
+        seed (int): The seed of the random generator
+
+    Returns:
+        list: The queries
+    """
+    rand = random.Random(seed)
+    places = tfidf.read_all_places()
+    words = " ".join(place["description"] for place in places).split()
+
+    queries = []
+    for _ in range(n):
+        kind = rand.random()
+        if kind < 0.3:
+            queries.append(rand.choice(places)["name"])
+        elif kind < 0.5:
+            queries.append(rand.choice(places)["description"])
+        else:
+            queries.append(" ".join(rand.sample(words, rand.randint(1, 3))))
+
+    return queries
+
+
+def latency(function, inputs: list) -> np.array:
+    """Measures the time a function takes for each input
+
+    Args:
+        function (function): The function to measure
+        inputs (list): The inputs the function is called with
+
+    Returns:
+        np.array: The time of each call in milliseconds
+    """
+    times = []
+    for x in inputs:
+        start = time.perf_counter()
+        function(x)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return np.array(times)
+
+
+def report(name: str, times: np.array) -> None:
+    """Prints the statistics of a latency measurement
+
+    Args:
+        name (str): The name of what was measured
+        times (np.array): The time of each call in milliseconds
+    """
+    print(f"{name:<24} mean {times.mean():9.4f} ms   p50 {np.percentile(times, 50):9.4f} ms   p99 {np.percentile(times, 99):9.4f} ms")
+
+
+def analyzers() -> None:
+    """Compares the NLTK and the fast analyzers on latency, tokens and search results
+    """
+    queries = sample_queries()
+
+    # Warm up so lazy loading of NLTK models is not measured
+    tfidf.preprocess_sentence(queries[0])
+
+    # Caches are skipped so every query is analyzed from scratch
+    report("nltk analyzer", latency(tfidf.preprocess_sentence, queries))
+    report("fast analyzer", latency(tfidf.fast_preprocess_sentence, queries))
+
+    tokens_overlap = []
+    results_overlap = []
+    for query in queries:
+        nltk_tokens = set(tfidf.preprocess_sentence(query))
+        fast_tokens = set(tfidf.fast_preprocess_sentence(query))
+        union = nltk_tokens | fast_tokens
+        tokens_overlap.append(len(nltk_tokens & fast_tokens) / len(union) if union else 1)
+
+        tfidf.ANALYZER = "nltk"
+        nltk_results = set(tfidf.cosine_search(query))
+        tfidf.ANALYZER = "fast"
+        fast_results = set(tfidf.cosine_search(query))
+        results_overlap.append(len(nltk_results & fast_results) / max(len(nltk_results), 1))
+
+    print(f"tokens overlap (jaccard)   {np.mean(tokens_overlap):.4f}")
+    print(f"top 10 results overlap     {np.mean(results_overlap):.4f}")
+
+
+def ann() -> None:
+    """Compares approximate search with exact search on recall@10 and latency, for different numbers of groups probed
+    """
+    queries = sample_queries()
+
+    # Warm up so lazy loading of NLTK models is not measured
+    tfidf.cosine_search(queries[0])
+
+    report("exact", latency(tfidf.cosine_search, queries))
+
+    # Only places that match some word of the query count as relevant
+    exact = []
+    for query in queries:
+        places, scores = tfidf.cosine_search(query, with_scores=True)
+        exact.append({place for place, score in zip(places, scores) if score > 0})
+
+    for probes in [1, 2, 4, 8, 16, 32]:
+        times = latency(lambda query: tfidf.ann_search(query, probes=probes), queries)
+        recall = [len(relevant & set(tfidf.ann_search(query, probes=probes))) / len(relevant) for query, relevant in zip(queries, exact) if relevant]
+        report(f"ann probes={probes}", times)
+        print(f"{'':<24} recall@10 {np.mean(recall):.4f}")
+
+
+def sample_likes(n_users: int = 50000, n_places: int = 20000, n_likes: int = 20, n_tastes: int = 200, seed: int = 0) -> Likes:
+    """Creates the likes of users that like mostly places of the same kind, so they have similar users
+
+    Args:
+        n_users (int): The number of users
+        n_places (int): The number of places
+        n_likes (int): The number of likes of each user
+        n_tastes (int): The number of kinds of places
+        seed (int): The seed of the random generator
+
+    Returns:
+        Likes: The likes
+    """
+    rand = np.random.default_rng(seed)
+    tastes = rand.integers(n_tastes, size=n_users)
+    kinds = rand.integers(n_tastes, size=n_places)
+    places = [np.flatnonzero(kinds == x) for x in range(n_tastes)]
+
+    # 80% of the likes of each user on places of its kind
+    rows = np.repeat(np.arange(n_users), n_likes)
+    columns = rand.integers(n_places, size=n_users * n_likes)
+    same = rand.random(n_users * n_likes) < 0.8
+    columns[same] = [rand.choice(places[tastes[x]]) for x in rows[same]]
+
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(n_users, n_places))
+    matrix.data[:] = 1
+    return Likes(matrix, [f"user{x}" for x in range(n_users)], [f"place{x}" for x in range(n_places)])
+
+
+def neighbors() -> None:
+    """Compares the neighbor backends on build time, memory, latency and recall@k against brute force
+    """
+    data = sample_likes()
+    queries = random.Random(0).sample(range(data.shape[0]), 500)
+    print(f"{data.shape[0]} users, {data.shape[1]} places, {data.matrix.nnz} likes")
+
+    # Exact neighbors of the users queried, comparing them to all users
+    vectors = sparse.diags(1 / np.maximum(data.norms[:data.shape[0]], 1e-12)) @ data.matrix
+    exact = []
+    start = time.perf_counter()
+    for row in queries:
+        scores = (vectors @ vectors[row].T).toarray().ravel()
+        scores[row] = 0
+        exact.append(-np.partition(-scores, knn.NEIGHBORS)[:knn.NEIGHBORS])
+    print(f"{'brute':<24} {(time.perf_counter() - start) * 1000 / len(queries):9.4f} ms per user")
+
+    start = time.perf_counter()
+    table = knn.kNearestNeighbors(data, backend="brute")
+    print(f"{'brute (all users)':<24} build {time.perf_counter() - start:9.4f} s   memory {(table.ids.nbytes + table.similarities.nbytes) / 2 ** 20:9.4f} MB")
+
+    for n_trees in [4, 8, 16, 32]:
+        knn.FOREST_TREES = n_trees
+        start = time.perf_counter()
+        forest = knn.build_forest(data)
+        build = time.perf_counter() - start
+
+        table = knn.Neighbors(np.full((data.shape[0], knn.NEIGHBORS), -1, dtype=np.int32), np.zeros((data.shape[0], knn.NEIGHBORS), dtype=np.float32), forest=forest)
+        times = latency(lambda row: knn.find_neighbors(table, data, row), queries)
+
+        # Neighbors as similar as the exact ones count as found, ties can be any of them
+        recall = []
+        for row, scores in zip(queries, exact):
+            found = table.similarities[row]
+            recall.append(np.mean([np.sum(found >= score - 1e-6) > i for i, score in enumerate(np.sort(scores)[::-1])]))
+
+        print(f"{f'forest trees={n_trees}':<24} build {build:9.4f} s   memory {forest.nbytes / 2 ** 20:9.4f} MB")
+        report("", times)
+        print(f"{'':<24} recall@{knn.NEIGHBORS} {np.mean(recall):.4f}")
+
+
+BENCHMARKS = {
+    "analyzers": analyzers,
+    "ann": ann,
+    "neighbors": neighbors
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python benchmark.py [{'|'.join(BENCHMARKS.keys())}]")
+        exit(1)
+
+    # Benchmarks run on the whole index, even if the server is sharded
+    tfidf.open_index()
+    BENCHMARKS[sys.argv[1]]()
@@ -0,0 +1,198 @@
+"""
+Random projection forest used to find similar users without comparing each user to all of them. Users are reduced to
+    a few dimensions with a truncated SVD of their likes (users share too few likes for a plain random projection to
+    keep them close), and each tree splits them in halves by random hyperplanes until there are at most leaf_size
+    users on each leaf. The users on the leaves a user falls into, on every tree, are the candidates to be its
+    neighbors. The more trees, the closer to comparing it to all users.
+"""
+
+import os
+import json
+
+import numpy as np
+from scipy import sparse
+
+from ml.ann import normalize
+
+# Forest saved by build, bump FOREST_VERSION whenever its format changes
+FOREST_VERSION = 1
+
+
+def svd_projection(matrix: sparse.csr_matrix, dimensions: int, iterations: int, seed: int) -> np.array:
+    """Finds the projection of the places to the dimensions that keep most of the likes, with a randomized SVD
+
+    Args:
+        matrix (sparse.csr_matrix): The likes of each user (rows)
+        dimensions (int): The number of dimensions
+        iterations (int): The number of power iterations, more are closer to the exact SVD
+        seed (int): The seed of the random generator
+
+    Returns:
+        np.array: The projection of each place (rows)
+    """
+    rand = np.random.default_rng(seed)
+    dimensions = min(dimensions, *matrix.shape)
+    samples = min(dimensions + 10, matrix.shape[1])
+
+    basis = matrix @ rand.standard_normal((matrix.shape[1], samples)).astype(np.float32)
+    for _ in range(iterations):
+        basis, _ = np.linalg.qr(basis)
+        basis = matrix @ (matrix.T @ basis)
+    basis, _ = np.linalg.qr(basis)
+
+    _, _, vt = np.linalg.svd((matrix.T @ basis).T, full_matrices=False)
+    return np.ascontiguousarray(vt[:dimensions].T, dtype=np.float32)
+
+
+class RandomProjectionForest:
+    """Trees of random hyperplanes over the reduced vectors of the users, all of them on the same arrays.
+        A node (or root) that is a leaf is stored as -(leaf + 1)
+    """
+
+    def __init__(self, projection: np.array, directions: np.array, thresholds: np.array, children: np.array, roots: np.array, indptr: np.array, ids: np.array) -> None:
+        """Creates the forest out of its arrays, as made by build
+
+        Args:
+            projection (np.array): The projection of each place to a few dimensions (rows)
+            directions (np.array): The normal of the hyperplane of each node (rows)
+            thresholds (np.array): Where the hyperplane of each node is along its normal
+            children (np.array): The nodes below and above the hyperplane of each node
+            roots (np.array): The root node of each tree
+            indptr (np.array): Where the users of each leaf start and end on ids
+            ids (np.array): The rows of the users of each leaf, one leaf after the other
+        """
+        self.projection = projection
+        self.directions = directions
+        self.thresholds = thresholds
+        self.children = children
+        self.roots = roots
+        self.indptr = indptr
+        self.ids = ids
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.projection, self.directions, self.thresholds, self.children, self.roots, self.indptr, self.ids))
+
+    @classmethod
+    def build(cls, matrix: sparse.csr_matrix, n_trees: int, leaf_size: int, dimensions: int, seed: int, iterations: int = 3) -> "RandomProjectionForest":
+        """Builds the trees of some users
+
+        Args:
+            matrix (sparse.csr_matrix): The likes of each user (rows)
+            n_trees (int): The number of trees
+            leaf_size (int): The maximum number of users on a leaf
+            dimensions (int): The number of dimensions users are reduced to
+            seed (int): The seed of the random generators
+            iterations (int): The number of power iterations of the SVD
+
+        Returns:
+            RandomProjectionForest: The forest
+        """
+        rand = np.random.default_rng(seed)
+        projection = svd_projection(matrix, dimensions, iterations, seed)
+        dimensions = projection.shape[1]
+        vectors = normalize(matrix @ projection).astype(np.float32)
+
+        directions, thresholds, children, roots, leaves = [], [], [], [], []
+
+        def split(ids: np.array) -> int:
+            if len(ids) <= leaf_size:
+                leaves.append(ids)
+                return -len(leaves)
+
+            # Half of the users on each side of a random hyperplane
+            direction = rand.standard_normal(dimensions).astype(np.float32)
+            projected = vectors[ids] @ direction
+            order = np.argsort(projected, kind="stable")
+            half = len(ids) // 2
+
+            node = len(directions)
+            directions.append(direction)
+            thresholds.append((projected[order[half - 1]] + projected[order[half]]) / 2)
+            children.append([0, 0])
+            children[node] = [split(ids[order[:half]]), split(ids[order[half:]])]
+            return node
+
+        for _ in range(n_trees):
+            roots.append(split(np.arange(matrix.shape[0], dtype=np.int32)))
+
+        return cls(
+            projection=projection,
+            directions=np.array(directions, dtype=np.float32).reshape(-1, dimensions),
+            thresholds=np.array(thresholds, dtype=np.float32),
+            children=np.array(children, dtype=np.int32).reshape(-1, 2),
+            roots=np.array(roots, dtype=np.int32),
+            indptr=np.concatenate(([0], np.cumsum([len(leaf) for leaf in leaves]))).astype(np.int64),
+            ids=np.concatenate(leaves + [np.zeros(0, dtype=np.int32)]).astype(np.int32)
+            )
+
+    def reduce(self, liked: np.array) -> np.array:
+        """Gets the reduced vector of a user, places added after the forest was built are left out
+
+        Args:
+            liked (np.array): The places (columns) liked by the user
+
+        Returns:
+            np.array: The unit vector on the reduced dimensions
+        """
+        liked = liked[liked < len(self.projection)]
+        return normalize(self.projection[liked].sum(axis=0, keepdims=True)).ravel()
+
+    def candidates(self, liked: np.array) -> np.array:
+        """Gets the users on the leaves of a user on every tree
+
+        Args:
+            liked (np.array): The places (columns) liked by the user
+
+        Returns:
+            np.array: The rows of the users (sorted)
+        """
+        vector = self.reduce(liked)
+
+        leaves = []
+        for node in self.roots:
+            while node >= 0:
+                node = self.children[node, int(vector @ self.directions[node] > self.thresholds[node])]
+            leaves.append(-node - 1)
+
+        return np.unique(np.concatenate([self.ids[self.indptr[x]:self.indptr[x + 1]] for x in leaves] + [np.zeros(0, dtype=np.int32)]))
+
+    def save(self, path: str) -> None:
+        """Saves the forest into a directory, as raw .npy arrays plus a .json file with its version
+
+        Args:
+            path (str): The directory where the forest is saved
+        """
+        os.makedirs(path, exist_ok=True)
+
+        for name in ("projection", "directions", "thresholds", "children", "roots", "indptr", "ids"):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+        # Metadata is written last so a half written forest is never loaded
+        with open(os.path.join(path, "forest.json"), "w") as file:
+            json.dump({"version": FOREST_VERSION}, file)
+
+    @classmethod
+    def load(cls, path: str) -> "RandomProjectionForest":
+        """Loads a forest saved with save, its arrays memory-mapped read only
+
+        Args:
+            path (str): The directory where the forest was saved
+
+        Returns:
+            RandomProjectionForest: The forest
+
+        Raises:
+            FileNotFoundError: if there is no forest saved on that directory
+            ValueError: if the forest saved was built by another version
+        """
+        with open(os.path.join(path, "forest.json")) as file:
+            meta = json.load(file)
+
+        if meta.get("version") != FOREST_VERSION:
+            raise ValueError(f"Forest version {meta.get('version')} is not supported, build it again")
+
+        def load(name: str) -> np.array:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        return cls(*[load(name) for name in ("projection", "directions", "thresholds", "children", "roots", "indptr", "ids")])
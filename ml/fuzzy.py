@@ -0,0 +1,145 @@
+"""
+Character trigram index used to correct misspelled words of the search queries. Instead of calculating the edit
+    distance to every word of the vocabulary, only words that share enough trigrams with the misspelled word are
+    compared, as each insertion, deletion or substitution can change at most 3 trigrams of a word. A transposition of
+    adjacent letters can change 4 of them, so words one transposition away are found from the word with those letters
+    swapped instead.
+"""
+
+import numpy as np
+
+
+def trigrams(word: str) -> list:
+    """Gets the character trigrams of a word, padded so the first and last letters have their own trigrams
+
+    Args:
+        word (str): The word
+
+    Returns:
+        list: The distinct trigrams of the word
+    """
+    padded = f"${word}$"
+    return list(dict.fromkeys(padded[i:i + 3] for i in range(len(padded) - 2)))
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Calculates the edit distance (insertions, deletions, substitutions and transpositions of adjacent letters)
+        between two words, stopping as soon as it is greater than max_distance
+
+    Args:
+        a (str): A word
+        b (str): Another word
+        max_distance (int): The maximum distance of interest
+
+    Returns:
+        int: The edit distance, or max_distance + 1 if it is greater than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = None
+    current = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+
+        if min(current) > max_distance:
+            return max_distance + 1
+
+    return min(current[-1], max_distance + 1)
+
+
+class TrigramIndex:
+    """Posting list of the words (their ids) that have each trigram
+    """
+
+    def __init__(self, terms: list) -> None:
+        """Creates the trigram index of a vocabulary
+
+        Args:
+            terms (list): The words, in order of their id
+        """
+        self.terms = list(terms)
+        self.ids = {term: i for i, term in enumerate(self.terms)}
+
+        postings = {}
+        for i, term in enumerate(self.terms):
+            for trigram in trigrams(term):
+                postings.setdefault(trigram, []).append(i)
+
+        self.postings = {trigram: np.array(ids, dtype=np.int32) for trigram, ids in postings.items()}
+
+    def add(self, terms: list) -> None:
+        """Adds words after the ones already on the index, they get the next ids
+
+        Args:
+            terms (list): The words, in order of their id
+        """
+        postings = {}
+        for i, term in enumerate(terms, start=len(self.terms)):
+            for trigram in trigrams(term):
+                postings.setdefault(trigram, []).append(i)
+
+        self.ids.update((term, i) for i, term in enumerate(terms, start=len(self.terms)))
+        self.terms.extend(terms)
+        for trigram, ids in postings.items():
+            self.postings[trigram] = np.concatenate((self.postings.get(trigram, np.array([], dtype=np.int32)), np.array(ids, dtype=np.int32)))
+
+    def candidates(self, word: str, max_distance: int) -> np.array:
+        """Gets the words that share enough trigrams with a word to be within max_distance edits of it
+
+        Args:
+            word (str): The word
+            max_distance (int): The maximum edit distance
+
+        Returns:
+            np.array: The ids of the candidate words
+        """
+        if max_distance == 0:
+            return np.array([self.ids[word]] if word in self.ids else [], dtype=np.int32)
+
+        grams = trigrams(word)
+        lists = [self.postings[x] for x in grams if x in self.postings]
+
+        ids = np.array([], dtype=np.int32)
+        if len(lists) > 0:
+            # Count how many trigrams each word shares with the word given
+            ids, counts = np.unique(np.concatenate(lists), return_counts=True)
+            ids = ids[counts >= len(grams) - 3 * max_distance]
+
+        # Words whose closest edits include a transposition are within one edit less of the word with those letters swapped
+        swapped = [word[:i] + word[i + 1] + word[i] + word[i + 2:] for i in range(len(word) - 1) if word[i] != word[i + 1]]
+        return np.unique(np.concatenate([ids] + [self.candidates(x, max_distance - 1) for x in swapped]))
+
+    def correct(self, word: str, max_distance: int, scores: np.array = None) -> list:
+        """Gets the words closest to a word, within max_distance edits
+
+        Args:
+            word (str): The word, usually misspelled
+            max_distance (int): The maximum edit distance
+            scores (np.array): If given, words with a score of 0 or less are skipped and ties are sorted by score
+
+        Returns:
+            list: The ids of the closest words, best first
+        """
+        best, distance = [], max_distance + 1
+
+        for i in self.candidates(word, max_distance):
+            if scores is not None and scores[i] <= 0:
+                continue
+
+            d = edit_distance(word, self.terms[i], max_distance=min(distance, max_distance))
+            if d < distance:
+                best, distance = [int(i)], d
+            elif d == distance and d <= max_distance:
+                best.append(int(i))
+
+        if scores is not None:
+            best.sort(key=lambda i: scores[i], reverse=True)
+
+        return best
@@ -0,0 +1,108 @@
+"""
+Grid index used to find the places within a radius of a location. Places are sorted by the cell of a grid of
+    latitude and longitude where they are, so the places of a row of cells are found with two binary searches and
+    only the places on the cells that overlap the radius are compared.
+"""
+
+import numpy as np
+
+# Mean radius of the Earth in meters
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(latitude: float, longitude: float, latitudes: np.array, longitudes: np.array) -> np.array:
+    """Calculates the great circle distance from a location to many others
+
+    Args:
+        latitude (float): The latitude of the location, in degrees
+        longitude (float): The longitude of the location, in degrees
+        latitudes (np.array): The latitudes of the other locations, in degrees
+        longitudes (np.array): The longitudes of the other locations, in degrees
+
+    Returns:
+        np.array: The distance to each location, in meters
+    """
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+
+    a = np.sin((latitudes - latitude) / 2) ** 2 + np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GeoIndex:
+    """Locations (their ids) sorted by the cell of the grid where they are
+    """
+
+    def __init__(self, latitudes: np.array, longitudes: np.array, cell_size: float = 0.05) -> None:
+        """Creates the grid index of some locations, locations without coordinates (NaN) are left out
+
+        Args:
+            latitudes (np.array): The latitude of each location, in degrees
+            longitudes (np.array): The longitude of each location, in degrees
+            cell_size (float): The size of the cells of the grid, in degrees
+        """
+        self.cell_size = cell_size
+        self.n_columns = int(np.ceil(360 / cell_size))
+
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        ids = np.flatnonzero(~np.isnan(latitudes) & ~np.isnan(longitudes))
+
+        cells = self.cell(latitudes[ids], longitudes[ids])
+        order = np.argsort(cells, kind="stable")
+        self.cells = cells[order]
+        self.ids = ids[order]
+        self.latitudes = latitudes[self.ids]
+        self.longitudes = longitudes[self.ids]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, latitude: np.array) -> np.array:
+        return np.floor((np.asarray(latitude) + 90) / self.cell_size).astype(np.int64)
+
+    def column(self, longitude: np.array) -> np.array:
+        return np.floor((np.asarray(longitude) + 180) / self.cell_size).astype(np.int64) % self.n_columns
+
+    def cell(self, latitude: np.array, longitude: np.array) -> np.array:
+        return self.row(latitude) * self.n_columns + self.column(longitude)
+
+    def search(self, latitude: float, longitude: float, radius: float) -> tuple:
+        """Gets the locations within a radius of a location
+
+        Args:
+            latitude (float): The latitude of the location, in degrees
+            longitude (float): The longitude of the location, in degrees
+            radius (float): The radius, in meters
+
+        Returns:
+            tuple: The ids of the locations within the radius (sorted) and their distance to the location, in meters
+        """
+        # Rows of cells between the southmost and northmost latitudes within the radius
+        angle = np.degrees(radius / EARTH_RADIUS)
+        south, north = max(latitude - angle, -90), min(latitude + angle, 90)
+
+        # Columns of cells between the westmost and eastmost longitudes, all of them if a pole is within the radius
+        if north >= 90 or south <= -90 or radius >= np.pi * EARTH_RADIUS / 2:
+            columns = [(0, self.n_columns - 1)]
+        else:
+            width = np.degrees(np.arcsin(min(np.sin(radius / EARTH_RADIUS) / np.cos(np.radians(latitude)), 1)))
+            west, east = self.column(longitude - width), self.column(longitude + width)
+            columns = [(west, east)] if west <= east else [(west, self.n_columns - 1), (0, east)]
+
+        # Places of the cells on each row are contiguous, so each row takes two binary searches
+        starts, ends = [], []
+        for row in range(self.row(south), self.row(north) + 1):
+            for first, last in columns:
+                starts.append(row * self.n_columns + first)
+                ends.append(row * self.n_columns + last)
+        starts = np.searchsorted(self.cells, starts, side="left")
+        ends = np.searchsorted(self.cells, ends, side="right")
+
+        candidates = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] + [np.array([], dtype=np.int64)])
+        distances = haversine(latitude, longitude, self.latitudes[candidates], self.longitudes[candidates])
+        keep = distances <= radius
+
+        ids, distances = self.ids[candidates[keep]], distances[keep]
+        order = np.argsort(ids)
+        return ids[order], distances[order]
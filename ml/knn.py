@@ -8,14 +8,20 @@ from pandas.core.frame import DataFrame
 sys.path.append(os.path.abspath(os.path.join('..')))
 
 from parse import Place, User
+from ml.likes import Likes, read_likes, grow
+from ml.forest import RandomProjectionForest
+from ml.similar import top_neighbors
+from ml.als import Factors
 from urllib.parse import urlencode
 import requests as r
 from dotenv import dotenv_values
 import json
 import random
+import threading
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from sklearn.neighbors import NearestNeighbors
 
 # Constants
@@ -26,6 +32,100 @@ HEADERS = {
     "X-Parse-REST-API-Key": SECRETS.get("PARSE_REST_API_KEY")
     }
 
+# Number of similar users each recommendation is based on, and number of places recommended
+NEIGHBORS = 4
+RECOMMENDATIONS = 5
+
+# Number of objects fetched on each request when exporting a whole class
+EXPORT_PAGE_SIZE = 10000
+
+# Likes and neighbors change with like events while requests are served
+LIKES_LOCK = threading.RLock()
+
+# How neighbors are found: brute compares every user to all users at startup, forest finds the neighbors of a user
+# the first time they are needed among the candidates of a random projection forest built offline (python knn.py)
+BACKENDS = ("brute", "forest")
+BACKEND = SECRETS.get("KNN_BACKEND", "brute")
+FOREST_DIR = "/Users/pabloblanco/Desktop/Places/server/ml/likes_forest"
+FOREST_TREES = 32
+FOREST_LEAF_SIZE = 64
+FOREST_DIMENSIONS = 32
+FOREST_SEED = 0
+
+# Recommendations by similar users, by places similar to the ones the user liked (out of a table of the most
+# similar places to each place) or by the factors of users and places trained with implicit ALS. The table and the
+# factors are built offline (python knn.py), bump ITEMS_VERSION whenever the contents of the table change
+METHODS = ("users", "items", "als")
+ITEMS_DIR = "/Users/pabloblanco/Desktop/Places/server/ml/likes_items"
+ITEMS_VERSION = 1
+ITEMS_SIZE = 50
+ITEMS_BLOCK_SIZE = 1024
+ALS_DIR = "/Users/pabloblanco/Desktop/Places/server/ml/likes_als"
+ALS_FACTORS = int(SECRETS.get("ALS_FACTORS", 32))
+ALS_THREADS = int(SECRETS.get("ALS_THREADS", os.cpu_count() or 1))
+ALS_ITERATIONS = 15
+ALS_REGULARIZATION = 0.1
+ALS_ALPHA = 20.0
+ALS_SEED = 0
+
+
+class Neighbors:
+    """Most similar users to each user (their rows, -1 where there are no more) and their cosine similarities,
+        most similar first. Rows are kept with room to spare so new users are added without copying the table.
+        With a forest, the neighbors of each user are found the first time they are needed
+    """
+
+    def __init__(self, ids: np.array, similarities: np.array, forest: RandomProjectionForest = None) -> None:
+        """Creates the table of neighbors
+
+        Args:
+            ids (np.array): The rows of the neighbors of each user (int32)
+            similarities (np.array): Their similarities (float32)
+            forest (RandomProjectionForest): The forest used to find the neighbors not found yet, if any
+        """
+        self.ids = ids
+        self.similarities = similarities
+        self.forest = forest
+        self.found = np.full(len(ids), forest is None)
+
+    def __getitem__(self, row: int) -> tuple:
+        """Gets the neighbors of a user that are similar to it at all, and their similarities
+        """
+        if row >= len(self.ids):
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        keep = (self.ids[row] >= 0) & (self.similarities[row] > 0)
+        return self.ids[row][keep], self.similarities[row][keep]
+
+    def grow(self, n_rows: int) -> None:
+        """Makes room for the neighbors of n_rows users
+        """
+        self.ids = grow(self.ids, n_rows, -1)
+        self.similarities = grow(self.similarities, n_rows, 0)
+        self.found = grow(self.found, n_rows, self.forest is None)
+
+    def offer(self, rows: np.array, other: int, similarities: np.array) -> None:
+        """Updates the similarity of a user to other users on their neighbors, adding it if it is now among the
+            most similar ones or removing it if it is not similar anymore
+
+        Args:
+            rows (np.array): The rows of the other users
+            other (int): The row of the user
+            similarities (np.array): The similarity of the user to each of the other users
+        """
+        ids = np.hstack((self.ids[rows], np.full((len(rows), 1), other, dtype=np.int32)))
+        scores = np.hstack((self.similarities[rows], similarities.reshape(-1, 1).astype(np.float32)))
+
+        # The old similarity of the user is replaced, and empty places go last
+        scores[:, :-1][ids[:, :-1] == other] = 0
+        scores[ids < 0] = 0
+        order = np.lexsort((np.where(scores > 0, ids, np.iinfo(np.int32).max), -scores))[:, :self.ids.shape[1]]
+
+        ids = np.take_along_axis(ids, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        ids[scores <= 0] = -1
+        self.ids[rows] = ids
+        self.similarities[rows] = scores
+
 
 def get_all_places() -> dict:
     """Gets all places and creates a dict from them so that each place can be retrieved by its objectId
@@ -118,115 +218,488 @@ def get_all_users():
     return _users
     
 
-def create_dataset():
+def export(path: str, keys: str, page_size: int = EXPORT_PAGE_SIZE):
+    """Goes through all the objects of a class of Parse server, one page at a time. Pages are sorted by objectId and
+        each one starts after the last objectId of the previous one, so no page needs to skip the ones before it
+
+    Args:
+        path (str): The path of the class, like /parse/classes/Like
+        keys (str): The fields of each object returned, separated by commas
+        page_size (int): The number of objects fetched on each request
+
+    Yields:
+        list: The objects of each page, only with the keys requested and objectId
     """
-    Creates the dataset and saves it as csv to read later
+    global SECRETS, PARSE_SERVER_URL, HEADERS
+    last = None
+
+    while True:
+        constraint = {"order": "objectId", "limit": page_size, "keys": keys}
+        if last is not None:
+            constraint["where"] = json.dumps({"objectId": {"$gt": last}})
+
+        response = r.get(url=PARSE_SERVER_URL + path + "?" + urlencode(constraint), headers=HEADERS)
+
+        if response.status_code != 200:
+            print(f"Request on {path} could not be completed")
+            print(response.json())
+            exit(1)
+
+        results = response.json().get("results", [])
+        if len(results) == 0:
+            return
+
+        yield results
+        last = results[-1]["objectId"]
+
+
+def export_likes() -> Likes:
+    """Gets all likes from Parse server, page by page, and puts them on a sparse matrix. Only the ids of each page
+        are kept, as the rows and columns of the likes, so memory grows with the number of likes
+
+    Returns:
+        Likes: All likes, with a row for each user and a column for each place (even the ones without likes)
     """
-    # Get values    
-    places = get_all_places()
-    users = get_all_users()
+    users, places = {}, {}
+    for page in export("/parse/users", keys="objectId"):
+        for _user in page:
+            users.setdefault(_user["objectId"], len(users))
+    for page in export(f"/parse/classes/{Place.class_name}", keys="objectId"):
+        for _place in page:
+            places.setdefault(_place["objectId"], len(places))
 
-    likes = []
-    for user in users.values():
-        likes.extend(get_likes(user.objectId))
+    rows, columns = [], []
+    for page in export("/parse/classes/Like", keys="user,place"):
+        page = [_like for _like in page if "user" in _like and "place" in _like]
+        rows.append(np.fromiter((users.setdefault(_like["user"]["objectId"], len(users)) for _like in page), dtype=np.int32, count=len(page)))
+        columns.append(np.fromiter((places.setdefault(_like["place"]["objectId"], len(places)) for _like in page), dtype=np.int32, count=len(page)))
 
-    # Create DataFrame
-    data = pd.DataFrame()
+    rows = np.concatenate(rows + [np.zeros(0, dtype=np.int32)])
+    columns = np.concatenate(columns + [np.zeros(0, dtype=np.int32)])
+    matrix = sparse.coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(users), len(places))).tocsr()
 
-    # Create colums in DataFrame
-    for user in users.keys():
-        data.insert(0, users[user].objectId, int(0))
+    # A user liking a place more than once counts once
+    matrix.data[:] = 1
 
-    # Create rows in DataFrame
-    values = [0 for _ in range(len(users))]
-    for place in places.keys():
-        data.loc[place] = values
+    return Likes(matrix, list(users), list(places))
 
-    # Fill data about likes
-    for like in likes:
-        data.loc[like["place"], like["user"]] = 1
 
-    # Convert DataFrame to .csv format
-    data.to_csv('/Users/pabloblanco/Desktop/Places/server/ml/likes.csv', index_label='places')
+def create_dataset():
+    """
+    Creates the dataset and saves it as a sparse matrix to read later
+    """
+    likes = export_likes()
+    likes.save()
 
 
-def read_data() -> pd.DataFrame:
-    """Reads the data stored from a .csv file and returns it's DataFrame
+def read_data() -> Likes:
+    """Reads the data stored as a sparse matrix, memory-mapped, and returns the likes of each user
 
     Returns:
-        pd.DataFrame: All data in order to create the model
+        Likes: All data in order to create the model, a row per user and a column per place
     """
-    return pd.read_csv("/Users/pabloblanco/Desktop/Places/server/ml/likes.csv", index_col="places").T
+    return read_likes()
     
     
-def create_model(data: DataFrame) -> NearestNeighbors:
+def create_model(data: Likes) -> NearestNeighbors:
     """Creates and fits the model to the existing data
     
     Args:
-        data (DataFrame): All the data in order to create KNN model
+        data (Likes): All the data in order to create KNN model
 
     Returns:
         NearestNeighbors: The model fitted ready to predict for a user
     """
     # Create KNN model
-    model = NearestNeighbors(metric='cosine', n_neighbors=5, algorithm='brute', n_jobs=-1)
-    model.fit(data)
+    model = NearestNeighbors(metric='cosine', n_neighbors=min(NEIGHBORS + 1, data.shape[0]), algorithm='brute', n_jobs=-1)
+    model.fit(data.matrix)
     
     return model
 
 
-def kNearestNeighbors() -> pd.DataFrame:
-    """Get a DataFrame with the K nearest neighbors for each user
+def build_forest(data: Likes) -> RandomProjectionForest:
+    """Builds the random projection forest of all users
+
+    Args:
+        data (Likes): All the data
+
+    Returns:
+        RandomProjectionForest: The forest
+    """
+    return RandomProjectionForest.build(data.matrix, n_trees=FOREST_TREES, leaf_size=FOREST_LEAF_SIZE, dimensions=FOREST_DIMENSIONS, seed=FOREST_SEED)
+
+
+def shared_likes(data: Likes, row: int, others: np.array) -> np.array:
+    """Counts the likes a user shares with other users (the dot product of their rows)
+
+    Args:
+        data (Likes): All the data
+        row (int): The row of the user
+        others (np.array): The rows of the other users
+
+    Returns:
+        np.array: The number of places liked by both the user and each other user
+    """
+    liked = np.zeros(data.shape[1], dtype=np.float32)
+    liked[data.liked(row)] = 1
+
+    # Rows with likes not merged yet are counted one by one
+    changed = np.array([x in data.row_changes or x >= data.matrix.shape[0] for x in others], dtype=bool)
+    shared = np.zeros(len(others), dtype=np.float32)
+    shared[~changed] = data.matrix[others[~changed]] @ liked[:data.matrix.shape[1]]
+    shared[changed] = [liked[data.liked(x)].sum() for x in others[changed]]
+
+    return shared
+
+
+def find_neighbors(neighbors: Neighbors, data: Likes, row: int) -> None:
+    """Finds the neighbors of a user among the candidates of the forest, comparing it only to them
+
+    Args:
+        neighbors (Neighbors): The knn of each user and their similarities
+        data (Likes): All the data
+        row (int): The row of the user
+    """
+    others = neighbors.forest.candidates(data.liked(row))
+    others = others[others != row]
+    similarities = shared_likes(data, row, others) / np.maximum(data.norms[row] * data.norms[others], 1e-12)
+
+    best = np.lexsort((others, -similarities))[:neighbors.ids.shape[1]]
+    neighbors.ids[row] = -1
+    neighbors.similarities[row] = 0
+    neighbors.ids[row, :len(best)] = others[best]
+    neighbors.similarities[row, :len(best)] = similarities[best]
+    neighbors.found[row] = True
+
+
+def kNearestNeighbors(data: Likes = None, backend: str = None) -> Neighbors:
+    """Get the K nearest neighbors of each user and how similar they are
     
+    Args:
+        data (Likes): All the data, read from the dataset if not given
+        backend (str): How neighbors are found, one of BACKENDS (BACKEND by default)
+
     Returns:
-        pd.DataFrame: The KNN for each user so that it can be compared and recommend a place
+        Neighbors: The NEIGHBORS most similar users to each user and their cosine similarities, so that they can be
+            compared and recommend a place
     """
-    data = read_data()
+    if data is None:
+        data = read_data()
+    if data.changes or data.matrix.shape != data.shape:
+        data.merge()
+
+    # With a forest no neighbors are found until they are needed
+    if (backend or BACKEND) == "forest":
+        try:
+            forest = RandomProjectionForest.load(FOREST_DIR)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Forest of users could not be loaded, building it: {e}")
+            forest = build_forest(data)
+        ids = np.full((data.shape[0], NEIGHBORS), -1, dtype=np.int32)
+        return Neighbors(ids, np.zeros(ids.shape, dtype=np.float32), forest=forest)
+
     model = create_model(data=data)
 
-    # Get top k neighbors indexes
-    # Get knn uids from indexes
-    top_k_users = model.kneighbors(data, return_distance=False)
-    neighbors = pd.DataFrame(np.array(top_k_users))
+    # Get top k neighbors indexes, each user is usually its own closest neighbor
+    distances, rows = model.kneighbors(data.matrix)
+    users = np.arange(data.shape[0])[:, None]
+
+    # Drop each user from its own neighbors, or the farthest neighbor when the user is not among them
+    itself = rows == users
+    itself[~itself.any(axis=1), -1] = True
+    n = rows.shape[1] - 1
+    ids = np.full((data.shape[0], NEIGHBORS), -1, dtype=np.int32)
+    similarities = np.zeros((data.shape[0], NEIGHBORS), dtype=np.float32)
+    ids[:, :n] = rows[~itself].reshape(-1, n)
+    similarities[:, :n] = 1 - distances[~itself].reshape(-1, n)
     
-    return neighbors
+    return Neighbors(ids, similarities)
 
 
-def recommend(neighbors: pd.DataFrame, data: pd.DataFrame, user: str) -> list:
-    """Recommends a place to a user according to similar users
+def recommend(neighbors: Neighbors, data: Likes, user: str, k: int = RECOMMENDATIONS) -> list:
+    """Recommends places to a user according to similar users. Each place liked by the neighbors of the user scores
+        the similarity of the neighbors that liked it, and the places with the highest scores the user has not liked
+        yet are recommended
 
     Args:
         user (str): The user id of the one making the request
-        neighbors (DataFrame): The knn of each user
-        data (DataFrame): The whole data
+        neighbors (Neighbors): The knn of each user and their similarities
+        data (Likes): The whole data
+        k (int): The number of places to recommend
 
     Returns:
-        list: The top 5 items (or less) to recommend to the user
+        list: The top k items (or less) to recommend to the user
     """
-    # Get the 4 users that relate most to the user
-    knn_index = list(neighbors.iloc[list(data.index).index(user)][1:])
-    knn = [list(data.index)[x] for x in knn_index]
-    
-    # Get places the user has liked
-    liked_by_user = []
-    for index, value in data.loc[user, :].items():
-        if value == 1:
-            liked_by_user.append(index)
-    
-    # Get places liked by related users
-    liked = []
-    for _user in knn:
+    with LIKES_LOCK:
+        row = data.user_rows.get(user)
+
+        # Users without likes yet have no neighbors
+        if row is None:
+            liked_by_user, knn, weights = [], np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        else:
+            liked_by_user = data.liked(row)
+            neighbors.grow(data.shape[0])
+            if not neighbors.found[row]:
+                find_neighbors(neighbors, data, row)
+            knn, weights = neighbors[row]
+
+        # Add up the similarity of the neighbors on each place they liked, only their likes are touched
+        likes = [data.liked(x) for x in knn]
+        columns = np.concatenate(likes + [np.zeros(0, dtype=np.int32)])
+        liked = best_places(data, columns, np.repeat(weights, [len(x) for x in likes]), liked_by_user, k)
         
-        # Find a place that the user hasn't liked and add it to the list
-        for index, value in data.loc[_user, :].items():
-            if value == 1 and index not in liked_by_user and len(liked) < 5:
-                liked.append(index)
+    return liked
+
+
+def best_places(data: Likes, columns: np.array, weights: np.array, liked_by_user: np.array, k: int) -> list:
+    """Adds up the scores of each place and gets the best ones the user has not liked yet, or a random place if
+        there are none
+
+    Args:
+        data (Likes): The whole data
+        columns (np.array): The places (columns) scored, with repetitions
+        weights (np.array): The score each time a place appears
+        liked_by_user (np.array): The places liked by the user (sorted)
+        k (int): The number of places to recommend
+
+    Returns:
+        list: The top k items (or less) to recommend to the user
+    """
+    places, inverse = np.unique(columns, return_inverse=True)
+    scores = np.bincount(inverse, weights=weights, minlength=len(places))
+
+    # Remove places the user has already liked
+    keep = ~np.isin(places, liked_by_user, assume_unique=True) & (scores > 0)
+    places, scores = places[keep], scores[keep]
+
+    # Get the k best, ties go to the first place
+    if len(places) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        places, scores = places[best], scores[best]
+    order = np.lexsort((places, -scores))
+    liked = [data.places[x] for x in places[order]]
         
-    # If no place to recommend then choose random        
-    while len(liked) == 0:
-        _place = random.choice(data.columns)
+    # If no place to recommend then choose random
+    liked_by_user = set(liked_by_user)
+    while len(liked) == 0 and len(liked_by_user) < data.shape[1]:
+        _place = random.randrange(data.shape[1])
         if _place not in liked_by_user:
-            liked.append(_place)
-        
+            liked.append(data.places[_place])
+
+    return liked
+
+
+def build_items(data: Likes) -> tuple:
+    """Finds the most similar places to each place by the users that liked them (cosine similarity of the columns),
+        comparing a block of places at a time with sparse products
+
+    Args:
+        data (Likes): The whole data
+
+    Returns:
+        tuple: The columns of the ITEMS_SIZE most similar places to each place (int32, -1 where there are no more)
+            and their similarities (float32)
+    """
+    if data.changes or data.matrix.shape != data.shape:
+        data.merge()
+
+    places = data.matrix.T.tocsr()
+    norms = np.sqrt(np.diff(places.indptr))
+    norms[norms == 0] = 1
+    places = sparse.diags(1 / norms) @ places
+    return top_neighbors(places, places, size=ITEMS_SIZE, offset=0, block_size=ITEMS_BLOCK_SIZE)
+
+
+def save_items(items: tuple, data: Likes, path: str = ITEMS_DIR) -> None:
+    """Saves the table of similar places into a directory, as raw .npy arrays plus a .json file with the places
+
+    Args:
+        items (tuple): The table of similar places and their similarities
+        data (Likes): The data the table was built from
+        path (str): The directory where the table is saved
+    """
+    os.makedirs(path, exist_ok=True)
+
+    ids, similarities = items
+    np.save(os.path.join(path, "ids.npy"), ids)
+    np.save(os.path.join(path, "similarities.npy"), similarities)
+
+    # Metadata is written last so a half written table is never loaded
+    with open(os.path.join(path, "items.json"), "w") as file:
+        json.dump({"version": ITEMS_VERSION, "places": data.places[:len(ids)]}, file)
+
+
+def read_items(data: Likes, path: str = ITEMS_DIR) -> tuple:
+    """Loads the table of similar places saved, memory-mapped, or builds it if it is missing or was built from
+        other places
+
+    Args:
+        data (Likes): The whole data
+        path (str): The directory where the table was saved
+
+    Returns:
+        tuple: The table of similar places and their similarities
+    """
+    try:
+        with open(os.path.join(path, "items.json")) as file:
+            meta = json.load(file)
+
+        if meta.get("version") != ITEMS_VERSION or meta["places"] != data.places[:len(meta["places"])]:
+            raise ValueError("the table was built from other places")
+
+        return np.load(os.path.join(path, "ids.npy"), mmap_mode="r"), np.load(os.path.join(path, "similarities.npy"), mmap_mode="r")
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Similar places could not be loaded, building them: {e}")
+        return build_items(data)
+
+
+def recommend_items(items: tuple, data: Likes, user: str, k: int = RECOMMENDATIONS) -> list:
+    """Recommends places to a user according to the places it has liked. Each place similar to a place the user
+        liked scores their similarity, so only ITEMS_SIZE places are touched for each like of the user
+
+    Args:
+        items (tuple): The table of similar places and their similarities
+        data (Likes): The whole data
+        user (str): The user id of the one making the request
+        k (int): The number of places to recommend
+
+    Returns:
+        list: The top k items (or less) to recommend to the user
+    """
+    ids, similarities = items
+
+    with LIKES_LOCK:
+        row = data.user_rows.get(user)
+        liked_by_user = data.liked(row) if row is not None else np.zeros(0, dtype=np.int32)
+
+        # Places added after the table was built have no similar places yet
+        rows = liked_by_user[liked_by_user < len(ids)]
+        columns, weights = ids[rows].ravel(), similarities[rows].ravel()
+        keep = columns >= 0
+        liked = best_places(data, columns[keep], weights[keep], liked_by_user, k)
+
     return liked
 
+
+def like(neighbors: Neighbors, data: Likes, user: str, place: str, liked: bool = True) -> bool:
+    """Adds a like of a user on a place, or removes it, and updates the neighbors of the users affected. Only the
+        users that share some like with the user (or liked the place) are compared to it again, so the cost grows with
+        them instead of with all users. The user gets its exact neighbors, and the others get the new similarity of
+        the user, so their neighbors are exact again only when they are calculated from scratch
+
+    Args:
+        neighbors (Neighbors): The knn of each user and their similarities
+        data (Likes): The whole data
+        user (str): The objectId of the user
+        place (str): The objectId of the place
+        liked (bool): If the like was added or removed
+
+    Returns:
+        bool: if the likes changed
+    """
+    with LIKES_LOCK:
+        row, changed = data.set_like(user=user, place=place, liked=liked)
+        if not changed:
+            return False
+        neighbors.grow(data.shape[0])
+
+        # Count the likes the user shares with every user that has liked the same places
+        likers = [data.likers(x) for x in data.liked(row)]
+        others, shared = np.unique(np.concatenate(likers + [np.zeros(0, dtype=np.int32)]), return_counts=True)
+        keep = others != row
+        others, shared = others[keep], shared[keep]
+        similarities = (shared / (data.norms[row] * data.norms[others])).astype(np.float32)
+
+        # Exact neighbors of the user
+        best = np.lexsort((others, -similarities))[:neighbors.ids.shape[1]]
+        neighbors.ids[row] = -1
+        neighbors.similarities[row] = 0
+        neighbors.ids[row, :len(best)] = others[best]
+        neighbors.similarities[row, :len(best)] = similarities[best]
+        neighbors.found[row] = True
+
+        # New similarity of the user to the others, users that liked the place and share nothing else are 0 now
+        left = np.setdiff1d(data.likers(data.place_columns[place]), np.append(others, row))
+        neighbors.offer(np.concatenate((others, left)).astype(np.int64), row, np.concatenate((similarities, np.zeros(len(left), dtype=np.float32))))
+
+    return True
+
+
+def train_factors(data: Likes) -> Factors:
+    """Trains the factors of users and places on all likes with implicit ALS
+
+    Args:
+        data (Likes): The whole data
+
+    Returns:
+        Factors: The factors
+    """
+    if data.changes or data.matrix.shape != data.shape:
+        data.merge()
+
+    return Factors.train(data.matrix, n_factors=ALS_FACTORS, iterations=ALS_ITERATIONS, regularization=ALS_REGULARIZATION, alpha=ALS_ALPHA, threads=ALS_THREADS, seed=ALS_SEED)
+
+
+def read_factors(data: Likes, path: str = ALS_DIR) -> Factors:
+    """Loads the factors saved, memory-mapped, or trains them if they are missing or were trained on other users or
+        places
+
+    Args:
+        data (Likes): The whole data
+        path (str): The directory where the factors were saved
+
+    Returns:
+        Factors: The factors
+    """
+    try:
+        return Factors.load(path, users=data.users, places=data.places)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Factors could not be loaded, training them: {e}")
+        return train_factors(data)
+
+
+def recommend_factors(factors: Factors, data: Likes, user: str, k: int = RECOMMENDATIONS) -> list:
+    """Recommends places to a user by the dot product of its factors and the factors of each place. Users that were
+        not trained get their factors from their likes, and places not trained are not recommended this way
+
+    Args:
+        factors (Factors): The factors of users and places
+        data (Likes): The whole data
+        user (str): The user id of the one making the request
+        k (int): The number of places to recommend
+
+    Returns:
+        list: The top k items (or less) to recommend to the user
+    """
+    with LIKES_LOCK:
+        row = data.user_rows.get(user)
+        liked_by_user = data.liked(row) if row is not None else np.zeros(0, dtype=np.int32)
+        vector = factors.users[row] if row is not None and row < len(factors.users) else factors.fold_in(liked_by_user)
+
+        # Remove places the user has already liked
+        scores = factors.items @ vector
+        scores[liked_by_user[liked_by_user < len(scores)]] = -np.inf
+
+        # Get the k best, ties go to the first place
+        candidates = np.flatnonzero(np.isfinite(scores))
+        if len(candidates) > k:
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        order = np.lexsort((candidates, -scores[candidates]))
+        liked = [data.places[x] for x in candidates[order]]
+
+    return liked
+
+
+if __name__ == "__main__":
+    # Build the forest of users, the table of similar places and the factors offline and save them so the server can load them
+    data = read_data()
+    forest = build_forest(data)
+    forest.save(FOREST_DIR)
+    print(f"Saved forest of {FOREST_TREES} trees ({forest.nbytes / 2 ** 20:.1f} MB)")
+
+    save_items(build_items(data), data)
+    print(f"Saved the {ITEMS_SIZE} most similar places to each of {data.shape[1]} places")
+
+    factors = train_factors(data)
+    factors.save(ALS_DIR, users=data.users, places=data.places)
+    print(f"Saved {ALS_FACTORS} factors of {data.shape[0]} users and {data.shape[1]} places")
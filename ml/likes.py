@@ -0,0 +1,306 @@
+"""
+Likes of the users as a sparse user×place matrix (CSR), with the objectIds of its rows and columns. Each row holds
+    the places a user has liked, so getting the likes of a user is a slice of the matrix and products with it only
+    touch the likes that exist. They are stored as raw .npy arrays (int32) that are memory-mapped when loaded, and
+    can be converted once from the old likes.csv running this file from this folder:
+
+    python likes.py
+"""
+
+import sys, os
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Likes stored by create_dataset, bump LIKES_VERSION whenever their format changes
+LIKES_DIR = "/Users/pabloblanco/Desktop/Places/server/ml/likes_matrix"
+LIKES_CSV = "/Users/pabloblanco/Desktop/Places/server/ml/likes.csv"
+LIKES_VERSION = 1
+
+# Number of places (rows of the .csv file) read at a time when converting it
+CSV_CHUNK_SIZE = 1000
+
+# Number of likes added or removed since the matrix was built that are merged into it
+CHANGES_MAX_SIZE = 1000
+
+
+def grow(array: np.array, size: int, fill) -> np.array:
+    """Makes room for at least size rows on an array, doubling it so rows are added one by one in constant time
+
+    Args:
+        array (np.array): The array
+        size (int): The number of rows needed
+        fill: The value of the new rows
+
+    Returns:
+        np.array: The array itself if there was room already, or a longer copy
+    """
+    if size <= len(array):
+        return array
+    extra = np.full((max(size, 2 * len(array)) - len(array),) + array.shape[1:], fill, dtype=array.dtype)
+    return np.concatenate((array, extra))
+
+
+class Likes:
+    """Sparse matrix of likes with the users (rows) and places (columns) it is indexed by.
+        Likes added or removed later are kept apart, by row and by column, until there are CHANGES_MAX_SIZE of them
+        and they are merged into the matrix, so each change costs the same no matter the size of the matrix
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, users: list, places: list) -> None:
+        """Creates the likes out of the matrix and the ids of its rows and columns
+
+        Args:
+            matrix (sparse.csr_matrix): 1 where a user (row) has liked a place (column)
+            users (list): The objectId of the user of each row
+            places (list): The objectId of the place of each column
+        """
+        self.matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+        self.matrix.sort_indices()
+        self.users = list(users)
+        self.places = list(places)
+        self.user_rows = {user: i for i, user in enumerate(self.users)}
+        self.place_columns = {place: i for i, place in enumerate(self.places)}
+
+        # Squared norm (number of likes) and norm of each row, with room for new users
+        self.counts = np.diff(self.matrix.indptr).astype(np.int32)
+        self.norms = np.sqrt(self.counts).astype(np.float32)
+
+        # Likes not merged yet, liked or not by (row, column), and the same by row and by column
+        self.changes = {}
+        self.row_changes = {}
+        self.column_changes = {}
+
+        # Users of each place, built on the first change
+        self.columns = None
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.users), len(self.places)
+
+    @classmethod
+    def from_frame(cls, data: pd.DataFrame) -> "Likes":
+        """Creates the likes out of a dense DataFrame with a row per user and a column per place
+
+        Args:
+            data (pd.DataFrame): Non zero where a user has liked a place
+
+        Returns:
+            Likes: The likes
+        """
+        return cls(sparse.csr_matrix(data.to_numpy() != 0), data.index.astype(str), data.columns.astype(str))
+
+    def liked(self, row: int) -> np.array:
+        """Gets the places (columns, sorted) liked by the user of a row
+        """
+        liked = self.matrix.indices[self.matrix.indptr[row]:self.matrix.indptr[row + 1]] if row < self.matrix.shape[0] else np.zeros(0, dtype=np.int32)
+        return apply_changes(liked, self.row_changes.get(row))
+
+    def likers(self, column: int) -> np.array:
+        """Gets the users (rows, sorted) that have liked the place of a column
+        """
+        if self.columns is None:
+            self.columns = self.matrix.tocsc()
+            self.columns.sort_indices()
+
+        likers = self.columns.indices[self.columns.indptr[column]:self.columns.indptr[column + 1]] if column < self.columns.shape[1] else np.zeros(0, dtype=np.int32)
+        return apply_changes(likers, self.column_changes.get(column))
+
+    def add_user(self, user: str) -> int:
+        """Adds a user without likes, if it is not there yet
+
+        Returns:
+            int: The row of the user
+        """
+        if user not in self.user_rows:
+            self.user_rows[user] = len(self.users)
+            self.users.append(user)
+            self.counts = grow(self.counts, len(self.users), 0)
+            self.norms = grow(self.norms, len(self.users), 0)
+        return self.user_rows[user]
+
+    def add_place(self, place: str) -> int:
+        """Adds a place without likes, if it is not there yet
+
+        Returns:
+            int: The column of the place
+        """
+        if place not in self.place_columns:
+            self.place_columns[place] = len(self.places)
+            self.places.append(place)
+        return self.place_columns[place]
+
+    def set_like(self, user: str, place: str, liked: bool = True) -> tuple:
+        """Adds a like of a user on a place, or removes it. Users and places that are not there yet are added
+
+        Args:
+            user (str): The objectId of the user
+            place (str): The objectId of the place
+            liked (bool): If the like is added or removed
+
+        Returns:
+            tuple: The row of the user and if the likes changed
+        """
+        row, column = self.add_user(user), self.add_place(place)
+
+        before = self.changes.get((row, column))
+        if before is None:
+            before = row < self.matrix.shape[0] and column in self.matrix.indices[self.matrix.indptr[row]:self.matrix.indptr[row + 1]]
+            if before == liked:
+                return row, False
+            self.changes[(row, column)] = liked
+            self.row_changes.setdefault(row, {})[column] = liked
+            self.column_changes.setdefault(column, {})[row] = liked
+        elif before == liked:
+            return row, False
+        else:
+            # Back to how it is on the matrix
+            del self.changes[(row, column)]
+            del self.row_changes[row][column]
+            del self.column_changes[column][row]
+
+        self.counts[row] += 1 if liked else -1
+        self.norms[row] = np.sqrt(self.counts[row])
+
+        if len(self.changes) >= CHANGES_MAX_SIZE:
+            self.merge()
+        return row, True
+
+    def merge(self) -> None:
+        """Merges the likes added or removed into the matrix, with the users and places added since it was built
+        """
+        n_rows, n_columns = self.shape
+        rows = np.repeat(np.arange(self.matrix.shape[0], dtype=np.int64), np.diff(self.matrix.indptr))
+        columns = self.matrix.indices.astype(np.int64)
+
+        changes = np.array([(row, column, liked) for (row, column), liked in self.changes.items()], dtype=np.int64).reshape(-1, 3)
+        removed = changes[changes[:, 2] == 0]
+        added = changes[changes[:, 2] == 1]
+        keep = ~np.isin(rows * n_columns + columns, removed[:, 0] * n_columns + removed[:, 1])
+
+        rows = np.concatenate((rows[keep], added[:, 0])).astype(np.int32)
+        columns = np.concatenate((columns[keep], added[:, 1])).astype(np.int32)
+        self.matrix = sparse.coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(n_rows, n_columns)).tocsr()
+        self.matrix.sort_indices()
+
+        self.changes, self.row_changes, self.column_changes = {}, {}, {}
+        self.columns = None
+
+    @classmethod
+    def from_csv(cls, path: str = LIKES_CSV, chunk_size: int = CSV_CHUNK_SIZE) -> "Likes":
+        """Reads the likes from a .csv file with a row per place and a column per user, as made by the old
+            create_dataset. Only chunk_size places are dense in memory at a time
+
+        Args:
+            path (str): The .csv file
+            chunk_size (int): The number of places read at a time
+
+        Returns:
+            Likes: The likes
+        """
+        places, rows, columns = [], [], []
+        for chunk in pd.read_csv(path, index_col="places", chunksize=chunk_size):
+            users = chunk.columns.astype(str)
+            place, user = np.nonzero(chunk.to_numpy() != 0)
+            rows.append(user.astype(np.int32))
+            columns.append((place + len(places)).astype(np.int32))
+            places.extend(chunk.index.astype(str))
+
+        if len(places) == 0:
+            users = pd.read_csv(path, index_col="places", nrows=0).columns.astype(str)
+
+        rows = np.concatenate(rows + [np.zeros(0, dtype=np.int32)])
+        columns = np.concatenate(columns + [np.zeros(0, dtype=np.int32)])
+        matrix = sparse.coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(users), len(places)))
+        return cls(matrix.tocsr(), users, places)
+
+    def save(self, path: str = LIKES_DIR) -> None:
+        """Saves the likes into a directory, as raw .npy arrays plus a .json file with the ids of users and places
+
+        Args:
+            path (str): The directory where the likes are saved
+        """
+        if self.changes or self.matrix.shape != self.shape:
+            self.merge()
+
+        os.makedirs(path, exist_ok=True)
+
+        np.save(os.path.join(path, "indptr.npy"), self.matrix.indptr.astype(np.int32))
+        np.save(os.path.join(path, "indices.npy"), self.matrix.indices.astype(np.int32))
+
+        # Metadata is written last so half written likes are never loaded
+        with open(os.path.join(path, "likes.json"), "w") as file:
+            json.dump({
+                "version": LIKES_VERSION,
+                "users": self.users,
+                "places": self.places
+                }, file)
+
+    @classmethod
+    def load(cls, path: str = LIKES_DIR) -> "Likes":
+        """Loads likes saved with save. Arrays are memory-mapped read only, so processes share the same pages
+
+        Args:
+            path (str): The directory where the likes were saved
+
+        Returns:
+            Likes: The likes
+
+        Raises:
+            FileNotFoundError: if there are no likes saved on that directory
+            ValueError: if the likes saved were stored by another version
+        """
+        with open(os.path.join(path, "likes.json")) as file:
+            meta = json.load(file)
+
+        if meta.get("version") != LIKES_VERSION:
+            raise ValueError(f"Likes version {meta.get('version')} is not supported, create the dataset again")
+
+        indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        indices = np.load(os.path.join(path, "indices.npy"), mmap_mode="r")
+        matrix = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr), shape=(len(meta["users"]), len(meta["places"])), copy=False)
+        return cls(matrix, meta["users"], meta["places"])
+
+
+def apply_changes(ids: np.array, changes: dict) -> np.array:
+    """Adds and removes ids from a row or column of the matrix
+
+    Args:
+        ids (np.array): The ids (sorted)
+        changes (dict): If each id changed was added or removed
+
+    Returns:
+        np.array: The ids after the changes (sorted)
+    """
+    if not changes:
+        return ids
+    removed = [x for x, liked in changes.items() if not liked]
+    added = [x for x, liked in changes.items() if liked]
+    return np.union1d(np.setdiff1d(ids, removed, assume_unique=True), added).astype(np.int32)
+
+
+def read_likes(path: str = LIKES_DIR, csv: str = LIKES_CSV) -> Likes:
+    """Loads the likes saved, converting them from the .csv file the first time
+
+    Args:
+        path (str): The directory where the likes are saved
+        csv (str): The .csv file they are converted from if they were never saved
+
+    Returns:
+        Likes: The likes
+    """
+    try:
+        return Likes.load(path)
+    except FileNotFoundError:
+        likes = Likes.from_csv(csv)
+        likes.save(path)
+        return likes
+
+
+if __name__ == "__main__":
+    # Convert the old .csv file and save it so the server can load it at startup
+    likes = Likes.from_csv(sys.argv[1] if len(sys.argv) > 1 else LIKES_CSV)
+    likes.save()
+    print(f"Saved {likes.matrix.nnz} likes of {likes.shape[0]} users on {likes.shape[1]} places")
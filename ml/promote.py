@@ -12,11 +12,11 @@ import sys, os
 sys.path.append(os.path.abspath(os.path.join('..')))
 
 from sklearn.neighbors import NearestNeighbors
-import pandas as pd
 import numpy as np
 import requests as r
 from dotenv import dotenv_values
 import json
+from ml.likes import read_likes
 
 # Constants
 SECRETS = dotenv_values(".env")
@@ -27,15 +27,16 @@ HEADERS = {
     "Content-Type": "application/json"
     }
 
-# Read data
-DATA = pd.read_csv("/Users/pabloblanco/Desktop/Places/server/ml/likes.csv", index_col="places")
+# Read data, a row per place and a column per user
+LIKES = read_likes()
+DATA = LIKES.matrix.T.tocsr()
 
 # Create KNN model and train it
-MODEL = NearestNeighbors(metric='cosine', n_neighbors=11, algorithm='brute', n_jobs=-1)
+MODEL = NearestNeighbors(metric='cosine', n_neighbors=min(11, DATA.shape[0]), algorithm='brute', n_jobs=-1)
 MODEL.fit(DATA)
 
 # Find most similar places of each place
-neighbors = pd.DataFrame(np.array(MODEL.kneighbors(DATA, return_distance=False)))
+neighbors = MODEL.kneighbors(DATA, return_distance=False)
 
 
 def get_best_users(place: str, user: str) -> list:
@@ -48,19 +49,16 @@ def get_best_users(place: str, user: str) -> list:
     Returns:
         list: A list that contains the 5 users that are the best to promote a place to
     """
-    global DATA
+    global LIKES, DATA
 
     # Get the 10 places that are most similar to the place passed
-    knn = [list(DATA.index)[x] for x in list(neighbors.iloc[list(DATA.index).index(place)][1:])]
-
-    # Get the information of the likes of all users on those 10 places
-    likes = DATA.loc[knn, :]
+    knn = neighbors[LIKES.place_columns[place]][1:]
 
     # Sum all likes per user on those 10 places
-    likes_per_user = likes.astype(bool).sum(axis=0)
+    likes_per_user = np.asarray(DATA[knn].sum(axis=0)).ravel()
 
     # Rank the users in order of how many likes the have given, and get the top 5
-    best_users = list(likes_per_user.sort_values(ascending=False).index)
+    best_users = [LIKES.users[x] for x in np.argsort(-likes_per_user, kind="stable")[:6]]
 
     # Remove user that create the promotion
     try:
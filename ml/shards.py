@@ -0,0 +1,317 @@
+"""
+Search index partitioned into shards, each one served by its own process. Places are assigned to a shard by the hash
+    of their objectId, each shard server loads only its part of the index (see tfidf.build_shards), and queries are
+    sent to all shards at once and their top places merged. Shard servers are reached by address, so they can also
+    run on other machines. They are started once, apart from the server workers that connect to them, from the
+    server folder (all of them, or a single one):
+
+    python -m ml.shards
+    python -m ml.shards <shard>
+"""
+
+import sys, os
+import atexit
+import heapq
+import subprocess
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from dotenv import dotenv_values
+
+SECRETS = dotenv_values("/Users/pabloblanco/Desktop/Places/server/.env")
+
+# Number of shards, 1 keeps the whole index on the server process. Shards listen on consecutive ports from SHARD_PORT,
+# or on the addresses given as host:port separated by commas on SEARCH_SHARD_ADDRESSES if they run on other machines
+SHARDS = int(SECRETS.get("SEARCH_SHARDS", 1))
+SHARD_HOST = "localhost"
+SHARD_PORT = int(SECRETS.get("SEARCH_SHARD_PORT", 6100))
+SHARD_ADDRESSES = SECRETS.get("SEARCH_SHARD_ADDRESSES")
+SHARDED = SHARDS > 1 or bool(SHARD_ADDRESSES)
+AUTHKEY = SECRETS.get("API_KEY", "True").encode()
+STARTUP_TIMEOUT = 600
+
+# Functions of the search index that shard servers run
+METHODS = ("cosine_search", "bm25_search", "ann_search", "batch_cosine_search", "nearby", "upsert_place", "remove_place", "update_statistics")
+
+
+def shard_of(objectId: str, n_shards: int) -> int:
+    """Gets the shard of a place, the same on every process and machine
+
+    Args:
+        objectId (str): The objectId of the place
+        n_shards (int): The number of shards
+
+    Returns:
+        int: The shard
+    """
+    return zlib.crc32(objectId.encode()) % n_shards
+
+
+def shard_addresses(n_shards: int = SHARDS) -> list:
+    """Gets the address of each shard server, the ones on SHARD_ADDRESSES or consecutive ports on this machine
+
+    Args:
+        n_shards (int): The number of shards, if no addresses were given
+
+    Returns:
+        list: The host and port of each shard, in order
+    """
+    if SHARD_ADDRESSES:
+        return [(host, int(port)) for host, port in (x.strip().rsplit(":", 1) for x in SHARD_ADDRESSES.split(","))]
+    return [(SHARD_HOST, SHARD_PORT + i) for i in range(n_shards)]
+
+
+def start_servers(n_shards: int = SHARDS) -> list:
+    """Starts a server for each shard on this machine and waits until all of them have loaded their shard.
+        It is meant to run once, not on every worker of the server
+
+    Args:
+        n_shards (int): The number of shards
+
+    Returns:
+        list: The process of each shard server
+
+    Raises:
+        RuntimeError: if some shard server stopped or did not start on time
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    processes = [subprocess.Popen([sys.executable, "-m", "ml.shards", str(i)], cwd=root) for i in range(n_shards)]
+    atexit.register(lambda: [process.terminate() for process in processes])
+
+    index = ShardedIndex(shard_addresses(n_shards))
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    for i, process in enumerate(processes):
+        while True:
+            try:
+                index.connect(i)
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"Shard {i} could not be started")
+                time.sleep(0.1)
+
+    return processes
+
+
+def merge_pages(pages: list, k: int, offset: int = 0, reverse: bool = True) -> tuple:
+    """Merges the results of each shard, already sorted, without sorting them again
+
+    Args:
+        pages (list): The places and their scores (or distances) of each shard
+        k (int): The number of places to return
+        offset (int): The number of best places to skip
+        reverse (bool): If higher scores go first, lower ones go first otherwise
+
+    Returns:
+        tuple: The best k places (after the offset given) and their scores
+    """
+    merged = heapq.merge(*[zip(places, scores) for places, scores in pages], key=lambda x: -x[1] if reverse else x[1])
+    page = list(islice(merged, offset, offset + k))
+    return [place for place, _ in page], [score for _, score in page]
+
+
+def serve(shard: int, address: tuple) -> None:
+    """Loads a shard of the index and answers the requests of the server, each connection on its own thread
+
+    Args:
+        shard (int): The shard
+        address (tuple): The host and port to listen on
+    """
+    # The search index loads only the shard set here
+    os.environ["SEARCH_SHARD"] = str(shard)
+    import ml.tfidf as tfidf
+
+    def handle(connection) -> None:
+        with connection:
+            while True:
+                try:
+                    method, kwargs = connection.recv()
+                except EOFError:
+                    return
+
+                if method not in METHODS:
+                    connection.send((False, f"{method} can not be called on a shard"))
+                    continue
+
+                try:
+                    connection.send((True, getattr(tfidf, method)(**kwargs)))
+                except Exception as e:
+                    connection.send((False, repr(e)))
+
+    with Listener(address, authkey=AUTHKEY) as listener:
+        print(f"Shard {shard} listening on {address[0]}:{address[1]}")
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, OSError, EOFError):
+                continue
+            threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+
+class ShardedIndex:
+    """Connections to the shard servers, queries are sent to all of them in parallel
+    """
+
+    def __init__(self, addresses: list = None) -> None:
+        """Creates the connections to the shard servers, they are opened on the first request
+
+        Args:
+            addresses (list): The host and port of each shard, in order, shard_addresses() by default
+        """
+        addresses = addresses or shard_addresses()
+        self.addresses = addresses
+        self.connections = [None] * len(addresses)
+        self.locks = [threading.Lock() for _ in addresses]
+        self.executor = ThreadPoolExecutor(max_workers=len(addresses))
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def connect(self, shard: int):
+        """Gets the connection to a shard, opening it if it is not open yet
+        """
+        if self.connections[shard] is None:
+            self.connections[shard] = Client(self.addresses[shard], authkey=AUTHKEY)
+        return self.connections[shard]
+
+    def call(self, shard: int, method: str, **kwargs):
+        """Calls a function of the search index on a shard
+
+        Args:
+            shard (int): The shard
+            method (str): The name of the function, one of METHODS
+            kwargs: The arguments of the function
+
+        Returns:
+            The result of the function
+
+        Raises:
+            RuntimeError: if the function failed on the shard
+        """
+        with self.locks[shard]:
+            try:
+                connection = self.connect(shard)
+                connection.send((method, kwargs))
+                ok, result = connection.recv()
+            except (EOFError, OSError):
+                # The connection is opened again on the next request
+                self.connections[shard] = None
+                raise
+
+        if not ok:
+            raise RuntimeError(f"Shard {shard}: {result}")
+        return result
+
+    def search(self, method: str, query: str, k: int = 10, offset: int = 0, **kwargs) -> tuple:
+        """Performs search on all shards at once and merges their results. Each shard returns its own best places
+            up to the page requested, so the best places overall are among them
+
+        Args:
+            method (str): The search function of the search index (cosine_search, bm25_search or ann_search)
+            query (str): The text introduced by the user
+            k (int): The number of places to return
+            offset (int): The number of best places to skip, to get the next pages of results
+            kwargs: Other arguments of the search function, like filters
+
+        Returns:
+            tuple: The top k places (after the offset given), their scores and the facet counts of all shards added up
+        """
+        results = self.call_all(method, query=query, k=offset + k, offset=0, with_scores=True, with_facets=True, **kwargs)
+        places, scores = merge_pages([(places, scores) for places, scores, _ in results], k, offset)
+
+        facets = {}
+        for _, _, counts in results:
+            for facet, values in counts.items():
+                facets.setdefault(facet, Counter()).update(values)
+
+        return places, scores, {facet: dict(values) for facet, values in facets.items()}
+
+    def batch_search(self, queries: list, k: int = 10, offset: int = 0) -> list:
+        """Performs search of many queries on all shards at once, with cosine similarity, and merges the results of
+            each query
+
+        Args:
+            queries (list): The texts introduced by the user
+            k (int): The number of places to return for each query
+            offset (int): The number of best places to skip, to get the next pages of results
+
+        Returns:
+            list: The top k places (after the offset given) and their scores, for each query
+        """
+        results = self.call_all("batch_cosine_search", queries=queries, k=offset + k, offset=0, with_scores=True)
+        return [merge_pages(pages, k, offset) for pages in zip(*results)]
+
+    def nearby(self, latitude: float, longitude: float, radius: float, k: int = 10, offset: int = 0) -> tuple:
+        """Gets the places closest to a location within a radius on all shards at once
+
+        Args:
+            latitude (float): The latitude of the location, in degrees
+            longitude (float): The longitude of the location, in degrees
+            radius (float): The radius, in meters
+            k (int): The number of places to return
+            offset (int): The number of closest places to skip, to get the next pages of results
+
+        Returns:
+            tuple: The closest k places (after the offset given) and their distance to the location, in meters
+        """
+        results = self.call_all("nearby", latitude=latitude, longitude=longitude, radius=radius, k=offset + k, offset=0)
+        return merge_pages(results, k, offset, reverse=False)
+
+    def call_all(self, method: str, **kwargs) -> list:
+        """Calls a function of the search index on all shards at once
+
+        Returns:
+            list: The result of the function on each shard
+        """
+        futures = [self.executor.submit(self.call, shard, method, **kwargs) for shard in range(len(self))]
+        return [future.result() for future in futures]
+
+    def upsert_place(self, place: dict) -> None:
+        """Adds a place to the search index of its shard, or updates it if it was already there
+        """
+        shard = shard_of(place["id"], len(self))
+        removed, added = self.call(shard, "upsert_place", place=place, with_statistics=True)
+        self.update_statistics(shard, added=[added], removed=[removed] if removed is not None else [])
+
+    def remove_place(self, objectId: str) -> bool:
+        """Removes a place from the search index of its shard
+
+        Returns:
+            bool: if the place was on the index
+        """
+        shard = shard_of(objectId, len(self))
+        found, removed = self.call(shard, "remove_place", objectId=objectId, with_statistics=True)
+        if found:
+            self.update_statistics(shard, removed=[removed])
+        return found
+
+    def update_statistics(self, shard: int, added: list = (), removed: list = ()) -> None:
+        """Sends the words and field lengths of the places added or removed on a shard to all other shards, so the
+            document frequencies and field lengths of all shards stay the same
+
+        Args:
+            shard (int): The shard where the places were added or removed
+            added (list): The words and field lengths of each place added
+            removed (list): The words and field lengths of each place removed
+        """
+        futures = [self.executor.submit(self.call, other, "update_statistics", added=added, removed=removed) for other in range(len(self)) if other != shard]
+        for future in futures:
+            future.result()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        # Start the servers of all shards and keep them running until one of them stops
+        processes = start_servers()
+        print(f"{len(processes)} shards started")
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+        exit(1)
+
+    shard = int(sys.argv[1])
+    serve(shard, (SHARD_HOST, SHARD_PORT + shard))
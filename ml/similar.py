@@ -0,0 +1,71 @@
+"""
+Table of the most similar places to each place, used for "more like this". Similarities are calculated by blocks of
+    places with sparse matrix products, so only a block of rows of the similarity matrix exists at a time, and only the
+    best neighbors of each place are kept (ids as int32 and similarities as float32, -1 where there are no more).
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+def top_neighbors(vectors: sparse.csr_matrix, matrix: sparse.csr_matrix, size: int, offset: int = None, block_size: int = 1024) -> tuple:
+    """Finds the rows of a matrix most similar (highest dot product) to each vector
+
+    Args:
+        vectors (sparse.csr_matrix): The vectors (rows)
+        matrix (sparse.csr_matrix): The rows to compare them with
+        size (int): The number of neighbors of each vector
+        offset (int): If given, vector i is row offset + i of the matrix, and is not its own neighbor
+        block_size (int): The number of vectors compared at a time
+
+    Returns:
+        tuple: The ids (rows of the matrix) of the neighbors of each vector, most similar first, and their similarities
+    """
+    ids = np.full((vectors.shape[0], size), -1, dtype=np.int32)
+    scores = np.zeros((vectors.shape[0], size), dtype=np.float32)
+
+    for start in range(0, vectors.shape[0], block_size):
+        block = (vectors[start:start + block_size] @ matrix.T).tocsr()
+        if offset is not None:
+            rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+            block.data[block.indices == rows + offset + start] = 0
+        block.eliminate_zeros()
+
+        for i in range(block.shape[0]):
+            columns = block.indices[block.indptr[i]:block.indptr[i + 1]]
+            data = block.data[block.indptr[i]:block.indptr[i + 1]]
+            n = min(size, len(data))
+            if n == 0:
+                continue
+
+            best = np.argpartition(-data, n - 1)[:n] if n < len(data) else np.arange(len(data))
+            best = best[np.lexsort((columns[best], -data[best]))]
+            ids[start + i, :n] = columns[best]
+            scores[start + i, :n] = data[best]
+
+    return ids, scores
+
+
+def merge_neighbors(ids: np.array, scores: np.array, other_ids: np.array, other_scores: np.array) -> tuple:
+    """Merges two tables of neighbors of the same places, keeping the best of both on each row
+
+    Args:
+        ids (np.array): The ids of the neighbors of each place, -1 where there are none
+        scores (np.array): Their similarities
+        other_ids (np.array): Other neighbors of each place (different from the first ones), -1 where there are none
+        other_scores (np.array): Their similarities
+
+    Returns:
+        tuple: The ids and similarities of the best neighbors of each place, with the same size as the first table
+    """
+    size = ids.shape[1]
+    ids = np.hstack((ids, other_ids))
+    scores = np.hstack((scores, other_scores))
+
+    # Empty places go last
+    order = np.argsort(np.where(ids < 0, np.inf, -scores), axis=1, kind="stable")[:, :size]
+    ids = np.take_along_axis(ids, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    scores[ids < 0] = 0
+
+    return ids, scores
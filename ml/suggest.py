@@ -0,0 +1,62 @@
+"""
+Prefix index used for the typeahead suggestions of the search. Keys are kept on a sorted list so all keys that
+    start with a prefix are found with two binary searches, and then ranked by the score given to each key.
+"""
+
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+
+class PrefixIndex:
+    """Sorted keys that point to a value (an integer id) with a score
+    """
+
+    def __init__(self, keys: list, values: list, scores: list) -> None:
+        """Creates the prefix index, the same value can be pointed to by many keys
+
+        Args:
+            keys (list): The strings to search for
+            values (list): The value of each key
+            scores (list): The score of each key, keys with higher scores are suggested first
+        """
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = [keys[i] for i in order]
+        self.values = np.asarray(values, dtype=np.int64)[order]
+        self.scores = np.asarray(scores, dtype=np.float64)[order]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def search(self, prefix: str, k: int = 5, allowed: np.array = None) -> list:
+        """Gets the values of the keys that start with a prefix, best scores first
+
+        Args:
+            prefix (str): The prefix
+            k (int): The maximum number of values to return
+            allowed (np.array): If given, only values where it is True are returned
+
+        Returns:
+            list: The best k distinct values (ties are broken by value)
+        """
+        start = bisect_left(self.keys, prefix)
+        end = bisect_right(self.keys, prefix + "\uffff", lo=start)
+
+        values = self.values[start:end]
+        scores = self.scores[start:end]
+
+        if allowed is not None:
+            keep = allowed[values]
+            values, scores = values[keep], scores[keep]
+
+        # Values pointed to by many keys are returned only once
+        values, first = np.unique(values, return_index=True)
+        scores = scores[first]
+
+        k = min(k, len(values))
+        if k <= 0:
+            return []
+
+        best = np.argpartition(-scores, k - 1)[:k] if k < len(values) else np.arange(len(values))
+        best = best[np.lexsort((values[best], -scores[best]))]
+        return [int(x) for x in values[best]]
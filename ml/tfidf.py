@@ -8,14 +8,24 @@ import sys, os
 sys.path.append(os.path.abspath(os.path.join('..')))
 
 import json
+import re
+import threading
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from urllib.parse import urlencode
 import requests as r
 from dotenv import dotenv_values
-from parse import Place
+from parse import Place, GeoPoint
+from ml.suggest import PrefixIndex
+from ml.fuzzy import TrigramIndex
+from ml.geo import GeoIndex, haversine
+from ml.ann import IVFIndex
+from ml.similar import top_neighbors, merge_neighbors
+from ml.shards import SHARDS, SHARDED, shard_of
 
 import numpy as np
-import pandas as pd
+from scipy import sparse
 
 import nltk
 
@@ -33,6 +43,10 @@ from nltk.corpus import wordnet
 
 # Constants
 LEMMATIZER = WordNetLemmatizer()
+PUNCTUATION = str.maketrans("", "", "!\"#$%&()*+-./:;<=>?@[\\]^_`{|}~\n'")
+QUERY_CACHE_SIZE = 4096
+LEMMA_CACHE_SIZE = 65536
+FAST_TOKENIZER = re.compile(r"[^\s,]+")
 SECRETS = dotenv_values("/Users/pabloblanco/Desktop/Places/server/.env")
 PARSE_SERVER_URL = SECRETS.get("PARSE_API_ADDRESS")
 HEADERS = {
@@ -40,6 +54,65 @@ HEADERS = {
     "X-Parse-REST-API-Key": SECRETS.get("PARSE_REST_API_KEY")
     }
 
+# Analyzer used on search queries: "nltk" runs the whole preprocessing pipeline, "fast" uses the lemma table
+ANALYZER = SECRETS.get("SEARCH_ANALYZER", "nltk")
+
+# Query words that are not on the vocabulary are replaced by the closest word, words shorter than
+# TYPO_MIN_LENGTH are never corrected and words up to TYPO_SHORT_LENGTH letters allow only one edit
+TYPO_TOLERANCE = True
+TYPO_MIN_LENGTH = 3
+TYPO_SHORT_LENGTH = 4
+TYPO_CACHE_SIZE = 16384
+
+# BM25F ranking defaults, all of them can be changed on each query
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_BOOSTS = {"name": 3.0, "description": 1.0}
+
+# Index built offline, bump INDEX_VERSION whenever its contents change
+INDEX_DIR = "/Users/pabloblanco/Desktop/Places/server/ml/index"
+INDEX_VERSION = 11
+
+# Attributes of the places that search results can be filtered and counted by, and the value of places without it
+FACET_ATTRIBUTES = {"category": "categories", "price": "prices", "public": "public"}
+MISSING_VALUES = {"categories": "", "prices": -1}
+
+# Approximate search: places are reduced to ANN_DIMENSIONS and grouped around sqrt(number of places) centroids,
+# found offline with k-means on at most ANN_TRAIN_SIZE places. Each query scores the places of the ANN_PROBES closest groups
+ANN_DIMENSIONS = 128
+ANN_PROBES = 8
+ANN_ITERATIONS = 10
+ANN_TRAIN_SIZE = 50000
+ANN_SEED = 0
+
+# Number of most similar places kept for each place, found by blocks of SIMILAR_BLOCK_SIZE places when the index is built
+SIMILAR_SIZE = 20
+SIMILAR_BLOCK_SIZE = 1024
+
+# Size in degrees of the cells of the grid used to find places near a location
+GEO_CELL_SIZE = 0.05
+
+# Places added or updated since the last merge are kept on a small delta segment, merged when it reaches this size
+DELTA_MAX_SIZE = 100
+INDEX_LOCK = threading.RLock()
+
+# Merges run one at a time on a background thread. While one runs, MERGING is the number of places at the front of
+# the delta segment being merged and MERGE_REMOVED has the objectIds of the places removed since it started
+MERGE_LOCK = threading.Lock()
+MERGE_THREAD = None
+MERGING = None
+MERGE_REMOVED = set()
+
+# Number of places on the base segment, None until the index is loaded or built
+N = None
+
+# Places are preprocessed in chunks on this many processes when the index is built offline
+BUILD_WORKERS = int(SECRETS.get("INDEX_BUILD_WORKERS", os.cpu_count() or 1))
+BUILD_CHUNK_SIZE = 256
+
+# Alpha is set to 0.3 as words in title will be more valuable (0.7) than words in description (0.3)
+ALPHA = 0.3
+
 
 # Create places .json so data can be accesed faster
 def get_all_places() -> dict:
@@ -64,10 +137,16 @@ def get_all_places() -> dict:
 
         for i, _place in enumerate(_places):
             place = Place(_place, simple=True)
+            location = GeoPoint(_place["location"]) if "location" in _place else None
             result.append({
                 "id": place.objectId,
                 "name": place.name,
-                "description": place.description
+                "description": place.description,
+                "likeCount": place.likeCount,
+                "category": _place["category"]["objectId"] if "category" in _place else None,
+                "price": place.price,
+                "public": place.public,
+                "location": {"latitude": location.latitude, "longitude": location.longitude} if location is not None else None
                 })
 
 
@@ -90,6 +169,123 @@ def read_all_places():
     return places
 
 
+class Vocabulary:
+    """Lookup table of all the words that appear on the places.
+        Each word gets an integer id (its column on the tf-idf matrix) and its document frequency and
+        inverse document frequency are precomputed, so every lookup is O(1)
+    """
+
+    def __init__(self, terms: list, df: np.array, n_documents: int) -> None:
+        """Creates the vocabulary
+
+        Args:
+            terms (list): The words, in order of their id
+            df (np.array): The document frequency of each word
+            n_documents (int): The number of documents
+        """
+        self.terms = list(terms)
+        self.ids = {term: i for i, term in enumerate(self.terms)}
+        self.n_documents = n_documents
+        self.df = np.asarray(df, dtype=np.int32)
+        self.idf = np.log(self.n_documents / (self.df + 1))
+
+    def add_document(self, tokens: list) -> None:
+        """Adds the words of a new document, updating document frequencies and idf
+
+        Args:
+            tokens (list): The tokens of the document
+        """
+        tokens = dict.fromkeys(tokens)
+        for token in tokens:
+            if token not in self.ids:
+                self.ids[token] = len(self.terms)
+                self.terms.append(token)
+
+        # A new array is created so a read only (memory-mapped) one is never written
+        df = np.zeros(len(self.terms), dtype=np.int32)
+        df[:len(self.df)] = self.df
+        df[[self.ids[token] for token in tokens]] += 1
+
+        self.n_documents += 1
+        self.df = df
+        self.idf = np.log(self.n_documents / (self.df + 1))
+
+    def remove_document(self, tokens: list) -> None:
+        """Removes the words of a document that was added before, updating document frequencies and idf.
+            Words are kept on the vocabulary even if no document has them anymore, so ids do not change until compact
+
+        Args:
+            tokens (list): The tokens of the document
+        """
+        df = np.array(self.df)
+        df[[self.ids[token] for token in set(tokens)]] -= 1
+
+        self.n_documents -= 1
+        self.df = df
+        self.idf = np.log(max(self.n_documents, 1) / (self.df + 1))
+
+    def compact(self, kept: np.array = None) -> np.array:
+        """Removes the words that no document has anymore (or the ones not given), the words after them get lower ids
+
+        Args:
+            kept (np.array): The ids of the words kept, in order, the words on some document by default
+
+        Returns:
+            np.array: The old id of each word kept, in order of their new ids
+        """
+        if kept is None:
+            kept = np.flatnonzero(self.df > 0)
+
+        self.terms = [self.terms[i] for i in kept]
+        self.ids = {term: i for i, term in enumerate(self.terms)}
+        self.df = self.df[kept]
+        self.idf = np.log(max(self.n_documents, 1) / (self.df + 1))
+        return kept
+
+    @classmethod
+    def from_documents(cls, documents: list):
+        """Creates the vocabulary out of the tokens of each document
+
+        Args:
+            documents (list): A list with the tokens of each document
+
+        Returns:
+            Vocabulary: The vocabulary of all documents
+        """
+        ids = {}
+        df = []
+
+        for tokens in documents:
+            # Words get their ids in order of first appearance so the vocabulary is always the same
+            for token in dict.fromkeys(tokens):
+                index = ids.get(token, None)
+                if index is None:
+                    ids[token] = len(df)
+                    df.append(1)
+                else:
+                    df[index] += 1
+
+        return cls(terms=list(ids.keys()), df=df, n_documents=len(documents))
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.ids
+
+    def get(self, term: str) -> int or None:
+        """Gets the id of a word
+
+        Args:
+            term (str): The word
+
+        Returns:
+            int: The id of the word
+            None: if the word is not on the vocabulary
+        """
+        return self.ids.get(term, None)
+
+
 def get_wordnet_pos(treebank_tag: str):
     """Returns the name of the tag for a WordNet TreeBank tag
 
@@ -111,7 +307,7 @@ def get_wordnet_pos(treebank_tag: str):
         return None
 
 
-def preprocess_sentence(sentence: str) -> list:
+def preprocess_sentence(sentence: str, lemmas: dict = None) -> list:
     """Preprocess a sentence by next steps:
         1. Getting tokens
         2. Turning them to lower case
@@ -121,18 +317,18 @@ def preprocess_sentence(sentence: str) -> list:
         6. Lemmatizing the words to get root
 
     Args:
-        sentence (str): [description]
+        sentence (str): The sentence to preprocess
+        lemmas (dict): If given, counts the lemma each word got (None if it was removed) to build the lemma table
 
     Returns:
-        list: [description]
+        list: The tokens of the sentence
     """
-    global LEMMATIZER
+    global PUNCTUATION
 
     tokens = word_tokenize(sentence)
     words = nltk.pos_tag(tokens)
 
     final = []
-    punctuation = "!\"#$%&()*+-./:;<=>?@[\]^_`{|}~\n'"
 
     for word, tag in words:
         # lowercase
@@ -143,8 +339,7 @@ def preprocess_sentence(sentence: str) -> list:
             continue
 
         # remove punctuation
-        for letter in punctuation:
-            word = word.replace(letter, "")
+        word = word.translate(PUNCTUATION)
 
         # remove one-letter words
         if len(word) <= 1:
@@ -152,18 +347,126 @@ def preprocess_sentence(sentence: str) -> list:
 
         # lemmatize word
         pos = get_wordnet_pos(tag)
-        if pos is None:
+        lemma = lemmatize(word, pos) if pos is not None else None
+
+        if lemmas is not None:
+            lemmas.setdefault(word, Counter())[lemma] += 1
+
+        if lemma is None:
+            continue
+
+        final.append(lemma)
+
+    return final
+
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(word: str, pos: str) -> str:
+    """Lemmatizes a word, results are cached as the same words show up over and over
+
+    Args:
+        word (str): The word
+        pos (str): The WordNet tag of the word
+
+    Returns:
+        str: The root of the word
+    """
+    global LEMMATIZER
+
+    return LEMMATIZER.lemmatize(word, pos)
+
+
+def fast_preprocess_sentence(sentence: str) -> list:
+    """Preprocess a sentence without NLTK, using a regex tokenizer and the lemma table made globally.
+        Every word that appears on some place is mapped to the same token it got when the places were
+        preprocessed (or removed if it was removed then). Words that do not appear on any place are kept as they are
+
+    Args:
+        sentence (str): The sentence to preprocess
+
+    Returns:
+        list: The tokens of the sentence
+    """
+    global LEMMAS, PUNCTUATION
+
+    final = []
+
+    for word in FAST_TOKENIZER.findall(sentence.lower()):
+        # remove punctuation
+        word = word.translate(PUNCTUATION)
+
+        # remove stopwords and one-letter words
+        if len(word) <= 1 or word in stop_words or word in stop_words_es:
             continue
 
-        word = LEMMATIZER.lemmatize(word, pos)
+        # get the root of the word from the lemma table
+        word = LEMMAS.get(word, word)
+        if word is None:
+            continue
 
         final.append(word)
 
     return final
 
 
+def preprocess_query(query: str, analyzer: str = None) -> tuple:
+    """Preprocess a search query with the analyzer given
+
+    Args:
+        query (str): The text entered by user as query
+        analyzer (str): Either "nltk" or "fast", ANALYZER by default
+
+    Returns:
+        tuple: The tokens of the query
+    """
+    global ANALYZER
+
+    if (analyzer or ANALYZER) == "fast":
+        return tuple(fast_preprocess_sentence(query))
+
+    return nltk_preprocess_query(query)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def nltk_preprocess_query(query: str) -> tuple:
+    """Preprocess a search query with preprocess_sentence. Results are cached, so repeated and popular
+        queries skip all NLP work
+
+    Args:
+        query (str): The text entered by user as query
+
+    Returns:
+        tuple: The tokens of the query
+    """
+    return tuple(preprocess_sentence(query))
+
+
+def lemma_table(lemmas: dict) -> dict:
+    """Creates the lemma table used by the fast analyzer, out of the lemmas counted by preprocess_sentence
+
+    Args:
+        lemmas (dict): The count of each lemma (or None) for each word
+
+    Returns:
+        dict: The most common lemma (or None) for each word
+    """
+    return {word: counter.most_common(1)[0][0] for word, counter in lemmas.items()}
+
+
+def cache_stats() -> dict:
+    """Gets the hits and misses of the preprocessing caches
+
+    Returns:
+        dict: The statistics of the query and lemma caches
+    """
+    return {
+        "queries": nltk_preprocess_query.cache_info()._asdict(),
+        "lemmas": lemmatize.cache_info()._asdict()
+        }
+
+
 def doc_freq(word: str) -> int:
-    """Gets the document frequency using the dictionary made globally
+    """Gets the document frequency using the vocabulary made globally
 
     Args:
         word (str): The word
@@ -171,51 +474,94 @@ def doc_freq(word: str) -> int:
     Returns:
         int: The document frequency of that word
     """
-    global DF
+    global VOCABULARY
 
-    freq = 0
-    try:
-        freq = DF[word]
-    except KeyError:
-        pass
-    return freq
+    index = VOCABULARY.get(word)
+    if index is None:
+        return 0
+    return int(VOCABULARY.df[index])
 
 
-def matching_score(query: str) -> list:
-    """Gets a text as a query and finds the top 10 places that have top tf-idf values for that query
+def postings(index: int) -> tuple:
+    """Gets the posting list of a word from the inverted index made globally
 
     Args:
-        query (str): The text entered by user as query
+        index (int): The id of the word on the vocabulary
 
     Returns:
-        list: The list of places that match the query
+        tuple: The places that contain the word (sorted) and the tf-idf of the word on each of them
     """
-    global TF_IDF
-
-    # Preprocess the query
-    tokens = preprocess_sentence(query)
+    global INVERTED
 
-    query_weights = {}
+    start, end = INVERTED.indptr[index], INVERTED.indptr[index + 1]
+    return INVERTED.indices[start:end], INVERTED.data[start:end]
 
-    # For each word in each document
-    for key in TF_IDF:
 
-        # If word in query, add document's value to query_weights
-        if key[1] in tokens:
-            try:
-                query_weights[key[0]] += TF_IDF[key]
-            except:
-                query_weights[key[0]] = TF_IDF[key]
+def matching_score(query: str, k: int = 10, with_scores: bool = False) -> list:
+    """Gets a text as a query and finds the top k places that have top tf-idf values for that query.
+        Scores are accumulated term at a time over the posting lists of the query words only. Words are visited
+        from the highest to the lowest maximum weight, and once the best score a place not seen yet could reach
+        is below the current k-th score, new places are no longer admitted (max-score early termination).
+        Places on the delta segment are scored directly as it is always small.
 
-    # Sort the weights to get highers on top
-    query_weights = sorted(query_weights.items(), key=lambda x: x[1], reverse=True)
+    Args:
+        query (str): The text entered by user as query
+        k (int): The number of places to return
+        with_scores (bool): If the score of each place should be returned too
 
-    # Get only index in places list
-    results = []
-    for i in query_weights[:10]:
-        results.append(i[0])
+    Returns:
+        list: The list of places that match the query, as rows of the index (see place_id)
+        tuple: The list of places and the list of their scores, if with_scores is True
+    """
+    global N, VOCABULARY, INVERTED, MAX_WEIGHTS, DELETED
 
-    return results
+    # Preprocess the query
+    tokens = set(preprocess_query(query))
+
+    with INDEX_LOCK:
+        # Correct misspelled words and keep only words that appear on some place
+        tokens = set(correct_tokens(tokens))
+        terms = [VOCABULARY.get(token) for token in tokens if token in VOCABULARY]
+
+        # Candidate places (sorted ids) and their accumulated scores, starting with the delta segment
+        delta_scores = np.asarray(delta_weights()[:, terms].sum(axis=1), dtype=np.float32).ravel()
+        ids = np.flatnonzero(delta_scores).astype(np.int32)
+        scores = delta_scores[ids]
+        ids += N
+
+        # Words of the base segment that some place still has, best words first
+        terms = [term for term in terms if term < INVERTED.shape[1] and INVERTED.indptr[term + 1] > INVERTED.indptr[term]]
+        terms.sort(key=lambda term: MAX_WEIGHTS[term], reverse=True)
+
+        # Best score that the remaining words can still add to a place
+        upper_bounds = np.cumsum(MAX_WEIGHTS[terms][::-1])[::-1]
+
+        for i, term in enumerate(terms):
+            doc_ids, weights = postings(term)
+            threshold = scores[top_k(scores, k)[-1]] if len(scores) >= k else -np.inf
+
+            if upper_bounds[i] < threshold:
+                # No new place can reach the top k, only update the current candidates
+                positions = np.searchsorted(doc_ids, ids).clip(max=len(doc_ids) - 1)
+                found = doc_ids[positions] == ids
+                scores[found] += weights[positions[found]]
+
+                # Drop candidates that can no longer reach the top k
+                remaining = upper_bounds[i + 1] if i + 1 < len(terms) else 0
+                keep = scores + remaining >= scores[top_k(scores, k)[-1]]
+                ids, scores = ids[keep], scores[keep]
+
+            else:
+                # Merge the posting list into the candidates, without places removed since the last merge
+                alive = ~DELETED[doc_ids]
+                ids, inverse = np.unique(np.concatenate((ids, doc_ids[alive])), return_inverse=True)
+                scores = np.bincount(inverse, weights=np.concatenate((scores, weights[alive])), minlength=len(ids)).astype(np.float32)
+
+        # Get only index in places list
+        out = top_k(scores, k)
+        if with_scores:
+            return [int(ids[x]) for x in out], [float(scores[x]) for x in out]
+        return [int(ids[x]) for x in out]
 
 
 def gen_vector(text: str) -> list:
@@ -227,26 +573,33 @@ def gen_vector(text: str) -> list:
     Returns:
         list: The resulting vector
     """
-    global total_vocab, total_vocab_size, N
+    return vectorize(preprocess_query(text))
 
-    tokens = preprocess_sentence(text)
 
-    V = np.zeros((total_vocab_size))
+def vectorize(tokens: list) -> np.array:
+    """Creates the tf-idf vector of a sentence that was already preprocessed
+
+    Args:
+        tokens (list): The tokens of the sentence
+
+    Returns:
+        np.array: The resulting vector
+    """
+    global VOCABULARY
+
+    V = np.zeros((len(VOCABULARY)))
 
     counter = Counter(tokens)
-    words_count = total_vocab_size
+    words_count = len(VOCABULARY)
 
-    for token in np.unique(tokens):
+    for token, count in counter.items():
 
-        tf = counter[token]/words_count
-        df = doc_freq(token)
-        idf = np.log((N)/(df+1))
+        index = VOCABULARY.get(token)
+        if index is None:
+            continue
 
-        try:
-            index = total_vocab.index(token)
-            V[index] = tf*idf
-        except:
-            pass
+        tf = count/words_count
+        V[index] = tf*VOCABULARY.idf[index]
 
     return V
 
@@ -266,145 +619,1440 @@ def cosine_similarity(a: np.array, b: np.array) -> float:
     return cos_sim
 
 
-# Get all places and preprocess them
-PLACES = read_all_places()
-for place in PLACES:
-    place["name"] = preprocess_sentence(place["name"])
-    place["description"] = preprocess_sentence(place["description"])
+def top_k(scores: np.array, k: int) -> np.array:
+    """Gets the indexes of the k highest scores without sorting the whole array
+
+    Args:
+        scores (np.array): The score of each place
+        k (int): The number of indexes to return
+
+    Returns:
+        np.array: The indexes of the top k scores, highest first (ties are broken by index)
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+
+    # Select the k best in linear time and only sort those
+    # Ties on the k-th score are resolved by index so pages of results are always consistent
+    threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+    above = np.flatnonzero(scores > threshold)
+    ties = np.flatnonzero(scores == threshold)[:k - len(above)]
+    best = np.concatenate((above, ties))
+    return best[np.lexsort((best, -scores[best]))]
+
+
+def count_matrix(documents: list, vocabulary: Vocabulary, n_terms: int = None) -> sparse.csr_matrix:
+    """Counts how many times each word appears on each document
+
+    Args:
+        documents (list): A list with the tokens of each document
+        vocabulary (Vocabulary): The vocabulary with the ids of the words
+        n_terms (int): The number of columns of the matrix, the size of the vocabulary by default
+
+    Returns:
+        sparse.csr_matrix: The count of each word (columns) on each document (rows)
+    """
+    n_terms = n_terms or len(vocabulary)
+
+    indptr, indices, data = [0], [], []
+    for tokens in documents:
+        counter = Counter(vocabulary.get(token) for token in tokens)
+        indices.extend(counter.keys())
+        data.extend(counter.values())
+        indptr.append(len(indices))
+
+    counts = sparse.csr_matrix((np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr)), shape=(len(documents), n_terms))
+    counts.sort_indices()
+    return counts
+
+
+def weigh(names: sparse.csr_matrix, descriptions: sparse.csr_matrix, words_count: int, idf: np.array = None) -> sparse.csr_matrix:
+    """Calculates the tf-idf of each word on each place out of the word counts of their name and description
+
+    Args:
+        names (sparse.csr_matrix): The count of each word on the name of each place
+        descriptions (sparse.csr_matrix): The count of each word on the description of each place
+        words_count (int): The number of words used to calculate the term frequency
+        idf (np.array): The inverse document frequency of each word, the one of the vocabulary made globally by default
+
+    Returns:
+        sparse.csr_matrix: The tf-idf of each word (columns) on each place (rows)
+    """
+    global VOCABULARY, ALPHA
+
+    if idf is None:
+        idf = VOCABULARY.idf
+
+    # Words in the name of a place also count as part of its description
+    names = names.astype(np.float64)
+    counts = (descriptions + names) * ALPHA + names * (1-ALPHA)
+
+    # tf-idf = (word count / vocabulary size) * idf of the word
+    idf = sparse.diags(idf[:counts.shape[1]] / words_count)
+    return (counts @ idf).astype(np.float32).tocsr()
+
+
+def normalize_rows(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    """Scales each row of a matrix so its L2 norm is 1, rows with only zeros are left as they are
+
+    Args:
+        matrix (sparse.csr_matrix): The matrix to normalize
+
+    Returns:
+        sparse.csr_matrix: The normalized matrix
+    """
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sparse.diags(1 / norms) @ matrix).astype(np.float32).tocsr()
+
+
+def weigh_counts(names: sparse.csr_matrix, descriptions: sparse.csr_matrix, vocabulary: Vocabulary) -> tuple:
+    """Calculates the tf-idf of places out of their word counts, along with the structures used to score them
+
+    Args:
+        names (sparse.csr_matrix): The count of each word on the name of each place
+        descriptions (sparse.csr_matrix): The count of each word on the description of each place
+        vocabulary (Vocabulary): The vocabulary the words are counted with
+
+    Returns:
+        tuple: The word counts of the name and of the description by word, the inverted index, the highest tf-idf of
+            each word and the tf-idf matrix with L2-normalized rows
+    """
+    weights = weigh(names, descriptions, words_count=len(vocabulary), idf=vocabulary.idf)
+
+    # word counts of each field by word, for BM25F
+    name_postings = names.tocsc()
+    name_postings.sort_indices()
+    description_postings = descriptions.tocsc()
+    description_postings.sort_indices()
+
+    # inverted index: for each word, the places that contain it (sorted) along with its tf-idf on them
+    inverted = weights.tocsc()
+    inverted.sort_indices()
+    max_weights = inverted.max(axis=0).toarray().ravel() if 0 not in inverted.shape else np.zeros(inverted.shape[1], dtype=np.float32)
+
+    # sparse matrix with tf-idf of each word/place
+    # rows are L2-normalized once so cosine similarity becomes a single dot product per place
+    return name_postings, description_postings, inverted, max_weights, normalize_rows(weights)
+
+
+def weigh_index() -> None:
+    """Calculates the tf-idf of all places on the base segment out of their word counts and sets it globally
+    """
+    global VOCABULARY, NAME_COUNTS, DESCRIPTION_COUNTS, NAME_POSTINGS, DESCRIPTION_POSTINGS, INVERTED, MAX_WEIGHTS, MATRIX
+
+    NAME_POSTINGS, DESCRIPTION_POSTINGS, INVERTED, MAX_WEIGHTS, MATRIX = weigh_counts(NAME_COUNTS, DESCRIPTION_COUNTS, VOCABULARY)
+    measure_fields()
+
+
+def measure_fields() -> None:
+    """Calculates the length (number of words) of the name and description of each place on the base segment
+        and sets them globally
+    """
+    global NAME_COUNTS, DESCRIPTION_COUNTS, FIELD_LENGTHS
+
+    FIELD_LENGTHS = {
+        "name": np.asarray(NAME_COUNTS.sum(axis=1)).ravel(),
+        "description": np.asarray(DESCRIPTION_COUNTS.sum(axis=1)).ravel()
+        }
+
+
+def average_lengths() -> dict:
+    """Gets the average length of the name and description of all places, out of the total lengths made globally
+
+    Returns:
+        dict: The average length of each field
+    """
+    global VOCABULARY, FIELD_TOTALS
+
+    n_documents = VOCABULARY.n_documents
+    return {field: max(total / n_documents, 1.0) if n_documents > 0 else 1.0 for field, total in FIELD_TOTALS.items()}
+
+
+def count_document(words: list, lengths: dict, sign: int = 1) -> None:
+    """Adds the words and field lengths of a place to the statistics of all places (the document frequency of each
+        word and the total length of each field), or removes them if sign is -1
+
+    Args:
+        words (list): The words of the place
+        lengths (dict): The length of each field of the place
+        sign (int): 1 if the place is added, -1 if it is removed
+    """
+    global VOCABULARY, FIELD_TOTALS, DELTA_WEIGHTS, DELTA_COUNTS, TYPOS
+
+    if sign > 0:
+        VOCABULARY.add_document(words)
+    else:
+        VOCABULARY.remove_document(words)
+
+    # New words can be corrections right away, and corrections made with the old document frequencies are dropped
+    if TYPOS is not None and len(TYPOS.terms) < len(VOCABULARY):
+        TYPOS.add(VOCABULARY.terms[len(TYPOS.terms):])
+    correct_word.cache_clear()
+
+    for field, length in lengths.items():
+        FIELD_TOTALS[field] += sign * length
+
+    # The delta segment is weighed again with the new document frequencies
+    DELTA_WEIGHTS = DELTA_COUNTS = None
+
+
+def update_statistics(added: list = (), removed: list = ()) -> None:
+    """Updates the statistics of all places with the places added or removed on other shards, so every shard keeps
+        the same document frequencies and field lengths as a single index
+
+    Args:
+        added (list): The words and field lengths of each place added, as returned by upsert_place
+        removed (list): The words and field lengths of each place removed, as returned by remove_place
+    """
+    with INDEX_LOCK:
+        for document in removed:
+            count_document(*document, sign=-1)
+        for document in added:
+            count_document(*document, sign=1)
+
+
+def reset_delta() -> None:
+    """Empties the delta segment and the places removed from the base segment
+    """
+    global N, PLACE_IDS, ROWS, DELETED, DELTA_IDS, DELTA_NAMES, DELTA_DESCRIPTIONS, DELTA_PLACES, DELTA_WEIGHTS, DELTA_COUNTS
+
+    ROWS = {objectId: i for i, objectId in enumerate(PLACE_IDS)}
+    DELETED = np.zeros(N, dtype=bool)
+    DELTA_IDS = []
+    DELTA_NAMES = []
+    DELTA_DESCRIPTIONS = []
+    DELTA_PLACES = []
+    DELTA_WEIGHTS = None
+    DELTA_COUNTS = None
+
+
+def place_attributes(places: list) -> dict:
+    """Gets the attributes of the places that are stored on the index along with their words
+
+    Args:
+        places (list): The places as read from the places .json file
+
+    Returns:
+        dict: An array with the values of each attribute, one value per place
+    """
+    # Places without location get NaN coordinates
+    locations = [place.get("location") or {} for place in places]
+
+    return {
+        "like_counts": np.array([place.get("likeCount", 0) for place in places], dtype=np.int32),
+        "categories": np.array([place.get("category") or MISSING_VALUES["categories"] for place in places], dtype=str),
+        "prices": np.array([MISSING_VALUES["prices"] if place.get("price") is None else place["price"] for place in places], dtype=np.int32),
+        "public": np.array([place.get("public", True) for place in places], dtype=bool),
+        "latitudes": np.array([location.get("latitude", np.nan) for location in locations], dtype=np.float64),
+        "longitudes": np.array([location.get("longitude", np.nan) for location in locations], dtype=np.float64)
+        }
+
+
+def make_suggestions(vocabulary: Vocabulary, place_names: list, like_counts: np.array) -> tuple:
+    """Builds the prefix indexes used for typeahead suggestions out of the vocabulary and the names of the places
+
+    Args:
+        vocabulary (Vocabulary): The vocabulary of the places
+        place_names (list): The name of each place (row)
+        like_counts (np.array): The number of likes of each place (row)
+
+    Returns:
+        tuple: The prefix index of words and the prefix index of places
+    """
+    # Words are ranked by document frequency
+    word_suggestions = PrefixIndex(keys=vocabulary.terms, values=np.arange(len(vocabulary)), scores=vocabulary.df)
+
+    # Places can be found by any word of their name, and are ranked by their likes
+    keys, rows = [], []
+    for i, name in enumerate(place_names):
+        words = name.lower().split()
+        for j in range(len(words)):
+            keys.append(" ".join(words[j:]))
+            rows.append(i)
+
+    return word_suggestions, PrefixIndex(keys=keys, values=rows, scores=like_counts[rows])
+
+
+def make_facets(attributes: dict) -> dict:
+    """Builds the values of each facet and the code of the value of each place (row), its position on the values,
+        so places are counted and filtered by value with a single pass over the codes
+
+    Args:
+        attributes (dict): The attributes of each place (row), as made by place_attributes
+
+    Returns:
+        dict: The values of each facet and the code of each place, -1 for places without a value
+    """
+    facets = {}
+    for facet, attribute in FACET_ATTRIBUTES.items():
+        values, codes = np.unique(attributes[attribute], return_inverse=True)
+        values, codes = values.tolist(), codes.astype(np.int32).ravel()
+
+        missing = MISSING_VALUES.get(attribute)
+        if missing in values:
+            i = values.index(missing)
+            codes[codes == i] = -1
+            codes[codes > i] -= 1
+            del values[i]
+
+        facets[facet] = (values, codes)
+
+    return facets
+
+
+def make_lookups(vocabulary: Vocabulary, place_names: list, attributes: dict) -> tuple:
+    """Builds all the structures used to look up words and places that are not part of the scoring
+
+    Args:
+        vocabulary (Vocabulary): The vocabulary of the places
+        place_names (list): The name of each place (row)
+        attributes (dict): The attributes of each place (row), as made by place_attributes
+
+    Returns:
+        tuple: The prefix indexes of words and of places used for suggestions, the trigram index of words, the grid
+            index of locations and the values of each facet with the code of the value of each place
+    """
+    word_suggestions, place_suggestions = make_suggestions(vocabulary, place_names, attributes["like_counts"])
+    typos = TrigramIndex(vocabulary.terms)
+    geo = GeoIndex(attributes["latitudes"], attributes["longitudes"], cell_size=GEO_CELL_SIZE)
+    return word_suggestions, place_suggestions, typos, geo, make_facets(attributes)
+
+
+def reset_lookups() -> None:
+    """Drops the structures used to look up words and places that are not part of the scoring, so they are built
+        again out of the index made globally the first time each one is used. Each worker that loads the index only
+        builds the ones it needs, when it needs them
+    """
+    global WORD_SUGGESTIONS, PLACE_SUGGESTIONS, TYPOS, GEO, FACETS
+
+    WORD_SUGGESTIONS = PLACE_SUGGESTIONS = TYPOS = GEO = FACETS = None
+    correct_word.cache_clear()
+
+
+def suggestion_indexes() -> tuple:
+    """Gets the prefix indexes of words and of places used for suggestions, building them if they were not yet
+
+    Returns:
+        tuple: The prefix index of words and the prefix index of places
+    """
+    global VOCABULARY, PLACE_NAMES, ATTRIBUTES, WORD_SUGGESTIONS, PLACE_SUGGESTIONS
+
+    with INDEX_LOCK:
+        if WORD_SUGGESTIONS is None:
+            WORD_SUGGESTIONS, PLACE_SUGGESTIONS = make_suggestions(VOCABULARY, PLACE_NAMES, ATTRIBUTES["like_counts"])
+
+        return WORD_SUGGESTIONS, PLACE_SUGGESTIONS
+
+
+def typo_index() -> TrigramIndex:
+    """Gets the trigram index of the words of the vocabulary, building it if it was not yet
+
+    Returns:
+        TrigramIndex: The trigram index
+    """
+    global VOCABULARY, TYPOS
+
+    with INDEX_LOCK:
+        if TYPOS is None:
+            TYPOS = TrigramIndex(VOCABULARY.terms)
+
+        return TYPOS
+
+
+def geo_index() -> GeoIndex:
+    """Gets the grid index of the locations of the places on the base segment, building it if it was not yet
+
+    Returns:
+        GeoIndex: The grid index
+    """
+    global ATTRIBUTES, GEO
+
+    with INDEX_LOCK:
+        if GEO is None:
+            GEO = GeoIndex(ATTRIBUTES["latitudes"], ATTRIBUTES["longitudes"], cell_size=GEO_CELL_SIZE)
+
+        return GEO
+
+
+def facet_codes() -> dict:
+    """Gets the values of each facet and the code of the value of each place on the base segment, building them if
+        they were not yet
+
+    Returns:
+        dict: The values of each facet and the code of each place, as made by make_facets
+    """
+    global ATTRIBUTES, FACETS
 
+    with INDEX_LOCK:
+        if FACETS is None:
+            FACETS = make_facets(ATTRIBUTES)
 
-# Create dictionary of document frequency with ids of documents
-N = len(PLACES)
-DF = {}
-for i in range(N):
-    tokens = PLACES[i]["description"]
-    tokens.extend(PLACES[i]["name"])
-    for w in tokens:
+        return FACETS
+
+
+@lru_cache(maxsize=TYPO_CACHE_SIZE)
+def correct_word(word: str) -> str or None:
+    """Gets the word of the vocabulary closest to a word that is not on it, using the trigram index of the vocabulary
+
+    Args:
+        word (str): The word, usually misspelled
+
+    Returns:
+        str: The closest word (the one on more places if there is a tie)
+        None: if no word is close enough
+    """
+    global VOCABULARY
+
+    if len(word) < TYPO_MIN_LENGTH:
+        return None
+
+    max_distance = 1 if len(word) <= TYPO_SHORT_LENGTH else 2
+    best = typo_index().correct(word, max_distance=max_distance, scores=VOCABULARY.df)
+
+    return VOCABULARY.terms[best[0]] if len(best) > 0 else None
+
+
+def correct_tokens(tokens: list) -> list:
+    """Replaces the tokens of a query that are not on the vocabulary by the closest word on it, if there is one
+
+    Args:
+        tokens (list): The tokens of the query
+
+    Returns:
+        list: The tokens corrected
+    """
+    global VOCABULARY
+
+    if not TYPO_TOLERANCE:
+        return list(tokens)
+
+    corrected = []
+    for token in tokens:
+        if token not in VOCABULARY:
+            token = correct_word(token) or token
+        corrected.append(token)
+
+    return corrected
+
+
+def preprocess_chunk(places: list) -> tuple:
+    """Preprocesses a chunk of places and counts their words, it runs on the worker processes of build_index
+
+    Args:
+        places (list): The places as read from the places .json file
+
+    Returns:
+        tuple: The vocabulary of the chunk, the word counts of the names and descriptions (with the ids of
+            that vocabulary) and the count of each lemma for the lemma table
+    """
+    lemmas = {}
+    names = [preprocess_sentence(place["name"], lemmas=lemmas) for place in places]
+    descriptions = [preprocess_sentence(place["description"], lemmas=lemmas) for place in places]
+
+    vocabulary = Vocabulary.from_documents([description + name for description, name in zip(descriptions, names)])
+
+    return vocabulary, count_matrix(names, vocabulary), count_matrix(descriptions, vocabulary), lemmas
+
+
+def merge_chunks(chunks: list) -> tuple:
+    """Merges the preprocessed chunks of places, in order, into a single vocabulary and word counts.
+        Word ids are given in order of first appearance, so the result is the same as preprocessing all places at once
+
+    Args:
+        chunks (list): The results of preprocess_chunk
+
+    Returns:
+        tuple: The vocabulary, the word counts of names and descriptions and the count of each lemma
+    """
+    ids = {}
+    df = []
+    names, descriptions = [], []
+    lemmas = {}
+
+    for vocabulary, chunk_names, chunk_descriptions, chunk_lemmas in chunks:
+        # Map the ids of the chunk to the ids of the merged vocabulary
+        mapping = np.empty(len(vocabulary), dtype=np.int32)
+        for j, term in enumerate(vocabulary.terms):
+            index = ids.get(term, None)
+            if index is None:
+                index = ids[term] = len(df)
+                df.append(0)
+            df[index] += int(vocabulary.df[j])
+            mapping[j] = index
+
+        for counts, merged in ((chunk_names, names), (chunk_descriptions, descriptions)):
+            merged.append(sparse.csr_matrix((counts.data, mapping[counts.indices], counts.indptr), shape=(counts.shape[0], len(df))))
+
+        for word, counter in chunk_lemmas.items():
+            lemmas.setdefault(word, Counter()).update(counter)
+
+    vocabulary = Vocabulary(terms=list(ids.keys()), df=df, n_documents=sum(x.shape[0] for x in names))
+
+    def stack(matrices: list) -> sparse.csr_matrix:
+        for matrix in matrices:
+            matrix.resize((matrix.shape[0], len(vocabulary)))
+        counts = sparse.vstack(matrices, format="csr") if matrices else sparse.csr_matrix((0, len(vocabulary)), dtype=np.float32)
+        counts.sort_indices()
+        return counts
+
+    return vocabulary, stack(names), stack(descriptions), lemmas
+
+
+def preprocess_places(places: list, workers: int = 1, chunk_size: int = BUILD_CHUNK_SIZE) -> list:
+    """Preprocesses places in chunks, in parallel if workers are given
+
+    Args:
+        places (list): The places as read from the places .json file
+        workers (int): The number of processes that preprocess the places, 1 preprocesses them on this process
+        chunk_size (int): The number of places each process preprocesses at a time
+
+    Returns:
+        list: The results of preprocess_chunk, in order
+    """
+    if workers > 1:
+        chunks = [places[i:i + chunk_size] for i in range(0, len(places), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(preprocess_chunk, chunks))
+
+    return [preprocess_chunk(places)]
+
+
+def build_index(places: list, workers: int = 1, chunk_size: int = BUILD_CHUNK_SIZE, chunks: list = None, frequencies: Vocabulary = None, totals: dict = None) -> None:
+    """Builds the tf-idf index of the places given and sets it globally
+
+    Args:
+        places (list): The places as read from the places .json file
+        workers (int): The number of processes that preprocess the places, 1 preprocesses them on this process
+        chunk_size (int): The number of places each process preprocesses at a time
+        chunks (list): The places already preprocessed with preprocess_places, if they were
+        frequencies (Vocabulary): The vocabulary of the whole catalog when the places are a shard of it, so every
+            shard has the same words with the same document frequencies
+        totals (dict): The total length of each field on the whole catalog when the places are a shard of it
+    """
+    global N, VOCABULARY, NAME_COUNTS, DESCRIPTION_COUNTS, FIELD_TOTALS, MATRIX, PLACE_IDS, PLACE_NAMES, ATTRIBUTES, LEMMAS, ANN, SIMILAR_IDS, SIMILAR_SCORES
+
+    # Preprocess all places, in parallel if workers are given
+    if chunks is None:
+        chunks = preprocess_places(places, workers=workers, chunk_size=chunk_size)
+
+    vocabulary, names, descriptions, lemmas = merge_chunks(chunks)
+    if frequencies is not None:
+        # Word counts are mapped to the ids of the vocabulary of the whole catalog
+        mapping = np.array([frequencies.get(term) for term in vocabulary.terms], dtype=np.int32)
+        names, descriptions = (sparse.csr_matrix((counts.data, mapping[counts.indices], counts.indptr), shape=(counts.shape[0], len(frequencies))) for counts in (names, descriptions))
+        names.sort_indices()
+        descriptions.sort_indices()
+        vocabulary = Vocabulary(terms=frequencies.terms, df=frequencies.df.copy(), n_documents=frequencies.n_documents)
+
+    with INDEX_LOCK:
+        # Vocabulary with document frequency of each word, and count of each word on the name and description of each place
+        N = len(places)
+        VOCABULARY = vocabulary
+        NAME_COUNTS = names
+        DESCRIPTION_COUNTS = descriptions
+        FIELD_TOTALS = dict(totals) if totals is not None else field_totals(names, descriptions)
+        LEMMAS = lemma_table(lemmas)
+
+        # objectId, name and attributes of the place on each row of the matrix
+        PLACE_IDS = [x["id"] for x in places]
+        PLACE_NAMES = [x["name"] for x in places]
+        ATTRIBUTES = place_attributes(places)
+
+        weigh_index()
+        ANN = IVFIndex.train(MATRIX, n_lists=int(np.sqrt(N)), dimensions=ANN_DIMENSIONS, iterations=ANN_ITERATIONS, sample_size=ANN_TRAIN_SIZE, seed=ANN_SEED)
+        SIMILAR_IDS, SIMILAR_SCORES = top_neighbors(MATRIX, MATRIX, SIMILAR_SIZE, offset=0, block_size=SIMILAR_BLOCK_SIZE)
+        reset_delta()
+        reset_lookups()
+
+
+def field_totals(names: sparse.csr_matrix, descriptions: sparse.csr_matrix) -> dict:
+    """Gets the total length (number of words) of the name and description of some places out of their word counts
+    """
+    return {"name": int(names.sum()), "description": int(descriptions.sum())}
+
+
+def shard_path(shard: int, path: str = INDEX_DIR) -> str:
+    """Gets the directory where a shard of the index is saved
+    """
+    return os.path.join(path, f"shard_{shard}")
+
+
+def build_shards(places: list, n_shards: int = SHARDS, workers: int = 1, path: str = INDEX_DIR) -> None:
+    """Builds the index of each shard of the places and saves it, places are assigned to a shard by their objectId.
+        All places are preprocessed once, and every shard gets the vocabulary of all places with their document
+        frequencies and the total length of each field, so the scores of a place are the same on its shard as on
+        a single index
+
+    Args:
+        places (list): The places as read from the places .json file
+        n_shards (int): The number of shards
+        workers (int): The number of processes that preprocess the places, 1 preprocesses them on this process
+        path (str): The directory where the index is saved, each shard is saved on its own directory inside it
+    """
+    shards = [[] for _ in range(n_shards)]
+    for place in places:
+        shards[shard_of(place["id"], n_shards)].append(place)
+
+    chunks = [preprocess_places(shard, workers=workers) for shard in shards]
+    frequencies, names, descriptions, _ = merge_chunks([chunk for shard in chunks for chunk in shard])
+    totals = field_totals(names, descriptions)
+
+    for i, shard in enumerate(shards):
+        build_index(shard, chunks=chunks[i], frequencies=frequencies, totals=totals)
+        save_index(shard_path(i, path))
+
+
+def save_index(path: str = INDEX_DIR) -> None:
+    """Saves the base segment of the index set globally into a directory, as raw .npy arrays plus a .json
+        file with the metadata. The delta segment should be merged before
+
+    Args:
+        path (str): The directory where the index is saved
+    """
+    global N, VOCABULARY, NAME_COUNTS, DESCRIPTION_COUNTS, NAME_POSTINGS, DESCRIPTION_POSTINGS, INVERTED, MAX_WEIGHTS, MATRIX, ANN, SIMILAR_IDS, SIMILAR_SCORES, PLACE_IDS, PLACE_NAMES, ATTRIBUTES, LEMMAS
+
+    os.makedirs(path, exist_ok=True)
+
+    arrays = {
+        "df": VOCABULARY.df,
+        "max_weights": MAX_WEIGHTS,
+        "name_counts_data": NAME_COUNTS.data,
+        "name_counts_indices": NAME_COUNTS.indices,
+        "name_counts_indptr": NAME_COUNTS.indptr,
+        "description_counts_data": DESCRIPTION_COUNTS.data,
+        "description_counts_indices": DESCRIPTION_COUNTS.indices,
+        "description_counts_indptr": DESCRIPTION_COUNTS.indptr,
+        "name_postings_data": NAME_POSTINGS.data,
+        "name_postings_indices": NAME_POSTINGS.indices,
+        "name_postings_indptr": NAME_POSTINGS.indptr,
+        "description_postings_data": DESCRIPTION_POSTINGS.data,
+        "description_postings_indices": DESCRIPTION_POSTINGS.indices,
+        "description_postings_indptr": DESCRIPTION_POSTINGS.indptr,
+        "inverted_data": INVERTED.data,
+        "inverted_indices": INVERTED.indices,
+        "inverted_indptr": INVERTED.indptr,
+        "matrix_data": MATRIX.data,
+        "matrix_indices": MATRIX.indices,
+        "matrix_indptr": MATRIX.indptr,
+        "ann_projection": ANN.projection,
+        "ann_centroids": ANN.centroids,
+        "ann_indptr": ANN.indptr,
+        "ann_ids": ANN.ids,
+        "similar_ids": SIMILAR_IDS,
+        "similar_scores": SIMILAR_SCORES
+    }
+    for name, array in ATTRIBUTES.items():
+        arrays[f"attribute_{name}"] = array
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+    # Metadata is written last so a half written index is never loaded
+    with open(os.path.join(path, "index.json"), "w") as file:
+        json.dump({
+            "version": INDEX_VERSION,
+            "n_documents": N,
+            "vocabulary_documents": VOCABULARY.n_documents,
+            "field_totals": FIELD_TOTALS,
+            "terms": VOCABULARY.terms,
+            "place_ids": PLACE_IDS,
+            "place_names": PLACE_NAMES,
+            "attributes": list(ATTRIBUTES.keys()),
+            "lemmas": LEMMAS
+            }, file)
+
+
+def load_index(path: str = INDEX_DIR) -> None:
+    """Loads an index saved with save_index and sets it globally.
+        Arrays are memory-mapped read only, so workers load it instantly and share the same pages
+
+    Args:
+        path (str): The directory where the index was saved
+
+    Raises:
+        FileNotFoundError: if there is no index saved on that directory
+        ValueError: if the index saved was built by another version
+    """
+    global N, VOCABULARY, NAME_COUNTS, DESCRIPTION_COUNTS, FIELD_TOTALS, NAME_POSTINGS, DESCRIPTION_POSTINGS, INVERTED, MAX_WEIGHTS, MATRIX, ANN, SIMILAR_IDS, SIMILAR_SCORES, PLACE_IDS, PLACE_NAMES, ATTRIBUTES, LEMMAS
+
+    with open(os.path.join(path, "index.json")) as file:
+        meta = json.load(file)
+
+    if meta.get("version") != INDEX_VERSION:
+        raise ValueError(f"Index version {meta.get('version')} is not supported, rebuild it")
+
+    def load(name: str) -> np.array:
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    def load_matrix(name: str, T: type) -> sparse.spmatrix:
+        return T((load(f"{name}_data"), load(f"{name}_indices"), load(f"{name}_indptr")), shape=shape, copy=False)
+
+    with INDEX_LOCK:
+        N = meta["n_documents"]
+        VOCABULARY = Vocabulary(terms=meta["terms"], df=load("df"), n_documents=meta["vocabulary_documents"])
+        shape = (N, len(VOCABULARY))
+        NAME_COUNTS = load_matrix("name_counts", sparse.csr_matrix)
+        DESCRIPTION_COUNTS = load_matrix("description_counts", sparse.csr_matrix)
+        FIELD_TOTALS = meta["field_totals"]
+        NAME_POSTINGS = load_matrix("name_postings", sparse.csc_matrix)
+        DESCRIPTION_POSTINGS = load_matrix("description_postings", sparse.csc_matrix)
+        measure_fields()
+        INVERTED = load_matrix("inverted", sparse.csc_matrix)
+        MATRIX = load_matrix("matrix", sparse.csr_matrix)
+        MAX_WEIGHTS = load("max_weights")
+        ANN = IVFIndex(projection=load("ann_projection"), centroids=load("ann_centroids"), indptr=load("ann_indptr"), ids=load("ann_ids"))
+        SIMILAR_IDS = load("similar_ids")
+        SIMILAR_SCORES = load("similar_scores")
+        PLACE_IDS = meta["place_ids"]
+        PLACE_NAMES = meta["place_names"]
+        ATTRIBUTES = {name: load(f"attribute_{name}") for name in meta["attributes"]}
+        LEMMAS = meta["lemmas"]
+        reset_delta()
+        reset_lookups()
+
+
+def open_index() -> None:
+    """Loads the index built offline, or builds it from the places if there is none, unless it was already loaded.
+        Shard servers load only the shard set on SEARCH_SHARD
+    """
+    with INDEX_LOCK:
+        if N is not None:
+            return
+
+        shard = os.environ.get("SEARCH_SHARD")
         try:
-            DF[w].add(i)
-        except KeyError:
-            DF[w] = {i}
+            load_index(INDEX_DIR if shard is None else shard_path(int(shard)))
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Search index could not be loaded, building it: {e}")
+            places = read_all_places()
+            build_index(places if shard is None else [place for place in places if shard_of(place["id"], SHARDS) == int(shard)])
 
-# Get only the frequency of appearance of each word
-for word in DF.keys():
-    DF[word] = len(DF[word])
 
-# Create variables neccessary for tf-idf
-total_vocab = list(DF.keys())
-total_vocab_size = len(total_vocab)
+def index_loaded() -> bool:
+    """Checks if the index was loaded or built on this process
+    """
+    return N is not None
 
-# Create variables to store tf-idf values of each word in both, title and text
-# Alpha is set to 0.3 as words in title will be more valuable (0.7) than words in description (0.3)
-tf_idf_text = {}
-tf_idf_title = {}
-alpha = 0.3
 
-# for each place calculate tf-idf for description
-for i, place in enumerate(PLACES):
+def delta_weights() -> sparse.csr_matrix:
+    """Gets the tf-idf of the places on the delta segment, calculated with the current document frequencies
 
-    # get tokens of that place's description
-    tokens = place["description"]
+    Returns:
+        sparse.csr_matrix: The tf-idf of each word (columns) on each place of the delta segment (rows)
+    """
+    global INVERTED, DELTA_WEIGHTS
 
-    # get word counts per document and total words
-    counter = Counter(tokens)
-    words_count = total_vocab_size
+    with INDEX_LOCK:
+        if DELTA_WEIGHTS is None:
+            names, descriptions = delta_counts()
+            # Same term frequency normalization as the base segment so scores are comparable
+            DELTA_WEIGHTS = weigh(names, descriptions, words_count=INVERTED.shape[1])
 
-    # for each word in document
-    for token in np.unique(tokens):
+        return DELTA_WEIGHTS
 
-        # get term-frequency
-        tf = counter[token]/words_count
 
-        # get inverse document frequency
-        idf = np.log(N/(doc_freq(token)+1))
+def delta_counts() -> tuple:
+    """Gets the word counts of the places on the delta segment
 
-        tf_idf_text[i, token] = tf*idf * alpha
+    Returns:
+        tuple: The count of each word (columns) on the name and on the description of each place of the delta segment (rows)
+    """
+    global VOCABULARY, DELTA_NAMES, DELTA_DESCRIPTIONS, DELTA_COUNTS
 
+    with INDEX_LOCK:
+        if DELTA_COUNTS is None:
+            DELTA_COUNTS = (count_matrix(DELTA_NAMES, VOCABULARY), count_matrix(DELTA_DESCRIPTIONS, VOCABULARY))
 
-    ### REPEAT PROCESS FOR NAME
-    tokens = place["name"]
+        return DELTA_COUNTS
 
-    # get word counts per document and total words
-    counter = Counter(tokens)
-    words_count = total_vocab_size
 
-    # for each word in document
-    for token in np.unique(tokens):
+def place_id(row: int) -> str:
+    """Gets the objectId of a place from its row on the index, the delta segment goes after the base segment
+
+    Args:
+        row (int): The row of the place
+
+    Returns:
+        str: The objectId of the place
+    """
+    global N, PLACE_IDS, DELTA_IDS
+
+    return PLACE_IDS[row] if row < N else DELTA_IDS[row - N]
+
+
+def remove_place(objectId: str, with_statistics: bool = False) -> bool:
+    """Removes a place from the search index
+
+    Args:
+        objectId (str): The objectId of the place
+        with_statistics (bool): If the words and field lengths of the place removed should be returned too
+
+    Returns:
+        bool: if the place was on the index
+        tuple: if the place was on the index and its words and field lengths (None if it was not), if with_statistics is True
+    """
+    global VOCABULARY, NAME_COUNTS, DESCRIPTION_COUNTS, ROWS, DELETED, DELTA_IDS, DELTA_NAMES, DELTA_DESCRIPTIONS, DELTA_PLACES, DELTA_WEIGHTS, DELTA_COUNTS, MERGING, MERGE_REMOVED
+
+    with INDEX_LOCK:
+        if objectId in DELTA_IDS:
+            # Places on the delta segment are removed from it
+            i = DELTA_IDS.index(objectId)
+            document = (DELTA_DESCRIPTIONS[i] + DELTA_NAMES[i], {"name": len(DELTA_NAMES[i]), "description": len(DELTA_DESCRIPTIONS[i])})
+            del DELTA_IDS[i], DELTA_NAMES[i], DELTA_DESCRIPTIONS[i], DELTA_PLACES[i]
+            DELTA_WEIGHTS = DELTA_COUNTS = None
+            if MERGING is not None and i < MERGING:
+                MERGING -= 1
+
+        else:
+            # Places on the base segment are marked as deleted until the next merge
+            row = ROWS.get(objectId, None)
+            if row is None or DELETED[row]:
+                return (False, None) if with_statistics else False
 
-        # get term-frequency
-        tf = counter[token]/words_count
+            words = np.union1d(NAME_COUNTS[row].indices, DESCRIPTION_COUNTS[row].indices)
+            document = ([VOCABULARY.terms[x] for x in words], {"name": int(NAME_COUNTS[row].sum()), "description": int(DESCRIPTION_COUNTS[row].sum())})
+            DELETED[row] = True
 
-        # get inverse document frequency
-        idf = np.log(N/(doc_freq(token)+1))
+        # A merge that is running still has the place, it is removed again when the merge is swapped in
+        if MERGING is not None:
+            MERGE_REMOVED.add(objectId)
 
-        tf_idf_title[i, token] = tf*idf * (1-alpha)
+        count_document(*document, sign=-1)
+        return (True, document) if with_statistics else True
 
 
-# Create total tf_idf of all words of all documents
-TF_IDF = {}
-for key in tf_idf_text.keys():
-    TF_IDF[key] = tf_idf_text[key] + tf_idf_title.pop(key, 0)
-for key in tf_idf_title.keys():
-    TF_IDF[key] = tf_idf_title.get(key, 0)
+def upsert_place(place: dict, with_statistics: bool = False) -> tuple or None:
+    """Adds a place to the search index, or updates it if it was already there.
+        The place is added to the delta segment so it is searchable right away, and the delta segment is
+        merged into the base segment on a background thread when it gets to DELTA_MAX_SIZE places
+
+    Args:
+        place (dict): The place, with the same keys as on the places .json file (id, name, description, likeCount, location, category, price and public)
+        with_statistics (bool): If the words and field lengths of the place removed and of the place added should be returned
+
+    Returns:
+        tuple: The words and field lengths of the place that was there before (None if there was none) and of the
+            place added, if with_statistics is True
+    """
+    global VOCABULARY, DELTA_IDS, DELTA_NAMES, DELTA_DESCRIPTIONS, DELTA_PLACES, DELTA_WEIGHTS, DELTA_COUNTS, LEMMAS, MERGE_THREAD
+
+    # Preprocess only the place given
+    lemmas = {}
+    name = preprocess_sentence(place["name"], lemmas=lemmas)
+    description = preprocess_sentence(place["description"], lemmas=lemmas)
+
+    with INDEX_LOCK:
+        removed = remove_place(place["id"], with_statistics=True)[1]
+
+        # New words are added to the lemma table, words already there keep their lemma
+        for word, lemma in lemma_table(lemmas).items():
+            LEMMAS.setdefault(word, lemma)
+
+        added = (description + name, {"name": len(name), "description": len(description)})
+        count_document(*added)
+        DELTA_IDS.append(place["id"])
+        DELTA_NAMES.append(name)
+        DELTA_DESCRIPTIONS.append(description)
+        DELTA_PLACES.append(place)
+        DELTA_WEIGHTS = DELTA_COUNTS = None
+
+        # The request does not wait for the merge, and no other merge starts while it runs
+        if len(DELTA_IDS) >= DELTA_MAX_SIZE and (MERGE_THREAD is None or not MERGE_THREAD.is_alive()):
+            MERGE_THREAD = threading.Thread(target=merge_index, daemon=True)
+            MERGE_THREAD.start()
+
+        if with_statistics:
+            return removed, added
+
+
+def merge_index() -> None:
+    """Merges the delta segment into the base segment, dropping the places that were removed.
+        Only word counts are merged and weights are recalculated, so no place is preprocessed again.
+        The merged segment is built without holding INDEX_LOCK, so searches and updates go on meanwhile, and it is
+        swapped in at the end along with the places added and removed while it was built
+    """
+    global N, VOCABULARY, NAME_COUNTS, DESCRIPTION_COUNTS, NAME_POSTINGS, DESCRIPTION_POSTINGS, INVERTED, MAX_WEIGHTS, MATRIX, PLACE_IDS, PLACE_NAMES, ATTRIBUTES, ANN, SIMILAR_IDS, SIMILAR_SCORES, ROWS, DELETED, DELTA_IDS, DELTA_NAMES, DELTA_DESCRIPTIONS, DELTA_PLACES, WORD_SUGGESTIONS, PLACE_SUGGESTIONS, TYPOS, GEO, FACETS, MERGING, MERGE_REMOVED
+
+    with MERGE_LOCK:
+        with INDEX_LOCK:
+            keep = np.flatnonzero(~DELETED)
+            if len(keep) == N and not DELTA_IDS:
+                return
+
+            # Segments are only replaced, never written, so the ones merged are not copied
+            MERGING = len(DELTA_IDS)
+            MERGE_REMOVED = set()
+            vocabulary = Vocabulary(terms=VOCABULARY.terms, df=VOCABULARY.df, n_documents=VOCABULARY.n_documents)
+            name_counts, description_counts, place_ids, place_names, attributes, ann, similar_ids, similar_scores = NAME_COUNTS, DESCRIPTION_COUNTS, PLACE_IDS, PLACE_NAMES, ATTRIBUTES, ANN, SIMILAR_IDS, SIMILAR_SCORES
+            delta_ids, delta_names, delta_descriptions, delta_places = DELTA_IDS[:], DELTA_NAMES[:], DELTA_DESCRIPTIONS[:], DELTA_PLACES[:]
+            n, n_terms = N, len(vocabulary)
 
+        try:
+            # New row of each place kept, -1 for places removed (and for no neighbor, the last one)
+            rows = np.full(n + 1, -1, dtype=np.int32)
+            rows[keep] = np.arange(len(keep))
+            similar_ids, similar_scores = rows[similar_ids[keep]], similar_scores[keep]
+            similar_scores = np.where(similar_ids < 0, 0, similar_scores).astype(np.float32)
+
+            def merge(counts: sparse.csr_matrix, delta: list) -> sparse.csr_matrix:
+                counts = counts[keep]
+                counts.resize((len(keep), n_terms))
+                return sparse.vstack((counts, count_matrix(delta, vocabulary, n_terms=n_terms)), format="csr")
+
+            name_counts = merge(name_counts, delta_names)
+            description_counts = merge(description_counts, delta_descriptions)
+
+            # Words that only places removed had are dropped, so they leave no empty posting lists behind
+            terms = vocabulary.compact()
+            name_counts = name_counts[:, terms]
+            description_counts = description_counts[:, terms]
+            name_counts.sort_indices()
+            description_counts.sort_indices()
+            projection = ann.projection[terms[terms < len(ann.projection)]]
+            place_ids = [place_ids[i] for i in keep] + delta_ids
+            place_names = [place_names[i] for i in keep] + [place["name"] for place in delta_places]
+            delta_attributes = place_attributes(delta_places)
+            attributes = {name: np.concatenate((array[keep], delta_attributes[name])) for name, array in attributes.items()}
+
+            # Places are assigned to the same centroids, they are only found again when the index is built offline
+            weights = weigh_counts(name_counts, description_counts, vocabulary)
+            matrix = weights[-1]
+            ann = IVFIndex(projection, ann.centroids, ann.indptr, ann.ids).assign(matrix, seed=ANN_SEED)
+
+            # New places are added to the neighbors of the places kept, and only the neighbors of new places are found
+            # (similarities of places kept are not recalculated until the index is built offline)
+            new = matrix[len(keep):]
+            ids, scores = top_neighbors(matrix[:len(keep)], new, SIMILAR_SIZE, block_size=SIMILAR_BLOCK_SIZE)
+            ids[ids >= 0] += len(keep)
+            similar_ids, similar_scores = merge_neighbors(similar_ids, similar_scores, ids, scores)
+            ids, scores = top_neighbors(new, matrix, SIMILAR_SIZE, offset=len(keep), block_size=SIMILAR_BLOCK_SIZE)
+            similar_ids = np.vstack((similar_ids, ids))
+            similar_scores = np.vstack((similar_scores, scores))
+
+            lookups = make_lookups(vocabulary, place_names, attributes)
+
+            with INDEX_LOCK:
+                # Words that places got since the merge started go after the words kept, with their current document frequencies
+                kept = np.zeros(len(VOCABULARY), dtype=bool)
+                kept[terms] = True
+                VOCABULARY.compact(np.concatenate((terms, np.flatnonzero(~kept & (VOCABULARY.df > 0)))))
+                NAME_COUNTS, DESCRIPTION_COUNTS = name_counts, description_counts
+                NAME_POSTINGS, DESCRIPTION_POSTINGS, INVERTED, MAX_WEIGHTS, MATRIX = weights
+                measure_fields()
+                ANN, SIMILAR_IDS, SIMILAR_SCORES = ann, similar_ids, similar_scores
+                PLACE_IDS, PLACE_NAMES, ATTRIBUTES = place_ids, place_names, attributes
+                N = len(PLACE_IDS)
+                WORD_SUGGESTIONS, PLACE_SUGGESTIONS, TYPOS, GEO, FACETS = lookups
+                TYPOS.add(VOCABULARY.terms[len(TYPOS.terms):])
+                correct_word.cache_clear()
+
+                # Places added while merging stay on the delta segment, and places removed (or updated) while merging
+                # are removed from the base segment
+                delta = DELTA_IDS[MERGING:], DELTA_NAMES[MERGING:], DELTA_DESCRIPTIONS[MERGING:], DELTA_PLACES[MERGING:]
+                reset_delta()
+                DELTA_IDS, DELTA_NAMES, DELTA_DESCRIPTIONS, DELTA_PLACES = delta
+                DELETED[[ROWS[objectId] for objectId in MERGE_REMOVED if objectId in ROWS]] = True
+
+        finally:
+            with INDEX_LOCK:
+                MERGING = None
+                MERGE_REMOVED = set()
+
+
+def suggest(prefix: str, k: int = 5) -> dict:
+    """Gets typeahead suggestions for what the user has typed so far, without running a search.
+        Places added since the last merge are not suggested yet
 
-# create matrix with tf-idf of each word/place
-matrix = np.zeros((N, total_vocab_size))
-for word in TF_IDF:
-    try:
-        index = total_vocab.index(word[1])
-        matrix[word[0]][index] = TF_IDF[word]
-    except:
-        pass
+    Args:
+        prefix (str): The text typed so far
+        k (int): The maximum number of words and of places to suggest
 
-# create dataframe and set index to place's objectId
-DATAFRAME = pd.DataFrame(matrix)
-DATAFRAME["objectId"] = pd.Series([x["id"] for x in PLACES])
-DATAFRAME = DATAFRAME.set_index("objectId", drop=True)
+    Returns:
+        dict: The words that complete the last word typed (most common first) and the places whose name
+            has a word that starts like the text typed (most liked first)
+    """
+    global PLACE_IDS, PLACE_NAMES, VOCABULARY, DELETED
 
+    words = prefix.lower().split()
+    if len(words) == 0:
+        return {"words": [], "places": []}
 
-def matching_score_search(query: str) -> list:
+    with INDEX_LOCK:
+        word_suggestions, place_suggestions = suggestion_indexes()
+
+        # Words that no place has anymore are not suggested
+        terms = word_suggestions.search(words[-1], k=k, allowed=VOCABULARY.df > 0)
+        rows = place_suggestions.search(" ".join(words), k=k, allowed=~DELETED)
+
+        return {
+            "words": [VOCABULARY.terms[x] for x in terms],
+            "places": [{"objectId": PLACE_IDS[x], "name": PLACE_NAMES[x]} for x in rows]
+            }
+
+
+def nearby_rows(latitude: float, longitude: float, radius: float) -> tuple:
+    """Gets the places within a radius of a location, using the grid index of the base segment.
+        Places on the delta segment are all compared as it is always small
+
+    Args:
+        latitude (float): The latitude of the location, in degrees
+        longitude (float): The longitude of the location, in degrees
+        radius (float): The radius, in meters
+
+    Returns:
+        tuple: The rows of the places within the radius (sorted, see place_id) and their distance to the location, in meters
+    """
+    global N, DELETED, DELTA_PLACES
+
+    with INDEX_LOCK:
+        rows, distances = geo_index().search(latitude, longitude, radius)
+        alive = ~DELETED[rows]
+        rows, distances = rows[alive], distances[alive]
+
+        delta = place_attributes(DELTA_PLACES)
+        delta_distances = haversine(latitude, longitude, delta["latitudes"], delta["longitudes"])
+        delta_rows = np.flatnonzero(delta_distances <= radius)
+
+        return np.concatenate((rows, delta_rows + N)), np.concatenate((distances, delta_distances[delta_rows]))
+
+
+def filter_rows(location: tuple = None, **facets) -> np.array:
+    """Gets the places that pass some filters. Facets are filtered with the value codes of the base segment, so no
+        place is compared one by one
+
+    Args:
+        location (tuple): The latitude and longitude (in degrees) of a location and a radius (in meters),
+            only places within the radius pass
+        facets (list): The values allowed of each facet (category, price or public), places with any of them pass
+
+    Returns:
+        np.array: If each place (row) passes all the filters given, None if no filter was given
+    """
+    global N, DELETED, DELTA_PLACES
+
+    facets = {facet: values for facet, values in facets.items() if values is not None}
+    if location is None and len(facets) == 0:
+        return None
+
+    with INDEX_LOCK:
+        allowed = np.concatenate((~DELETED, np.ones(len(DELTA_PLACES), dtype=bool)))
+
+        if location is not None:
+            near = np.zeros(len(allowed), dtype=bool)
+            near[nearby_rows(*location)[0]] = True
+            allowed &= near
+
+        delta = place_attributes(DELTA_PLACES)
+        base = facet_codes()
+        for facet, values in facets.items():
+            known, codes = base[facet]
+            selected = [i for i, value in enumerate(known) if value in values]
+            allowed[:N] &= np.logical_or.reduce([codes == i for i in selected]) if len(selected) > 0 else False
+            allowed[N:] &= np.isin(delta[FACET_ATTRIBUTES[facet]], values)
+
+        return allowed
+
+
+def facet_counts(rows: np.array) -> dict:
+    """Counts how many places have each value of each facet
+
+    Args:
+        rows (np.array): The places (rows) to count
+
+    Returns:
+        dict: The number of places with each value, for each facet. Values no place has are left out
+    """
+    global N, DELTA_PLACES
+
+    with INDEX_LOCK:
+        base = facet_codes()
+        rows = np.asarray(rows)
+        delta = place_attributes([DELTA_PLACES[x - N] for x in rows[rows >= N]])
+        rows = rows[rows < N]
+
+        counts = {}
+        for facet, attribute in FACET_ATTRIBUTES.items():
+            # Only the codes of the places given are counted, not a mask of every place for each value
+            values, codes = base[facet]
+            codes = codes[rows]
+            count = Counter(dict(zip(values, np.bincount(codes[codes >= 0], minlength=len(values)).tolist())))
+            count.update(value for value in delta[attribute].tolist() if value != MISSING_VALUES.get(attribute))
+            counts[facet] = {value: int(n) for value, n in count.items() if n > 0}
+
+        return counts
+
+
+def nearby(latitude: float, longitude: float, radius: float, k: int = 10, offset: int = 0) -> tuple:
+    """Gets the places closest to a location within a radius, without comparing places outside of it
+
+    Args:
+        latitude (float): The latitude of the location, in degrees
+        longitude (float): The longitude of the location, in degrees
+        radius (float): The radius, in meters
+        k (int): The number of places to return
+        offset (int): The number of closest places to skip, to get the next pages of results
+
+    Returns:
+        tuple: The closest k places (after the offset given) and their distance to the location, in meters
+    """
+    with INDEX_LOCK:
+        rows, distances = nearby_rows(latitude, longitude, radius)
+
+        # Closest first, the same as the highest scores first
+        out = top_k(-distances, k=offset + k)[offset:]
+        return [place_id(rows[x]) for x in out], [float(distances[x]) for x in out]
+
+
+def similar(objectId: str, k: int = 10) -> tuple:
+    """Gets the places most similar in content (cosine similarity of their tf-idf) to a place. Places on the base
+        segment have their neighbors on the table made when the index was built, so they are looked up instead of
+        calculated, and places on the delta segment are compared with all places. Places on the delta segment are
+        always compared too, as it is small
+
+    Args:
+        objectId (str): The objectId of the place
+        k (int): The number of places to return, at most SIMILAR_SIZE places of the base segment are returned
+
+    Returns:
+        tuple: The most similar places (best first) and their similarities
+
+    Raises:
+        KeyError: if the place is not on the index
+    """
+    global N, MATRIX, ROWS, DELETED, DELTA_IDS, SIMILAR_IDS, SIMILAR_SCORES
+
+    with INDEX_LOCK:
+        delta = normalize_rows(delta_weights())
+
+        if objectId in DELTA_IDS:
+            row = N + DELTA_IDS.index(objectId)
+            vector = delta[row - N]
+            ids, scores = top_neighbors(vector[:, :MATRIX.shape[1]], MATRIX, SIMILAR_SIZE)
+        else:
+            row = ROWS.get(objectId, None)
+            if row is None or DELETED[row]:
+                raise KeyError(objectId)
+            vector = MATRIX[row]
+            vector.resize((1, delta.shape[1]))
+            ids, scores = SIMILAR_IDS[row:row + 1], SIMILAR_SCORES[row:row + 1]
+
+        # Neighbors on the base segment, along with all places on the delta segment but the place itself
+        delta_scores = (delta @ vector.T).toarray().ravel()
+        ids = np.concatenate((ids[0], np.arange(len(delta_scores)) + N))
+        scores = np.concatenate((scores[0], delta_scores))
+
+        alive = (ids >= 0) & (ids != row) & (scores > 0)
+        alive[alive & (ids < N)] &= ~DELETED[ids[alive & (ids < N)]]
+        ids, scores = ids[alive], scores[alive]
+
+        out = top_k(scores, k)
+        return [place_id(ids[x]) for x in out], [float(scores[x]) for x in out]
+
+
+def matching_score_search(query: str, k: int = 10, offset: int = 0, with_scores: bool = False) -> list:
     """Performs the search inside all the places
 
     Args:
         query (str): The text that the user entered
+        k (int): The number of places to return
+        offset (int): The number of best places to skip, to get the next pages of results
+        with_scores (bool): If the score of each place should be returned too
 
     Returns:
         list: The list of places as a result
+        tuple: The list of places and the list of their scores, if with_scores is True
     """
-    global PLACES
+    # Only the places up to the page requested are selected
+    places_ids, scores = matching_score(query, k=offset + k, with_scores=True)
 
     results = []
-    places_ids = matching_score(query)
-    for id in places_ids:
-        results.append(PLACES[id]["id"])
+    for id in places_ids[offset:]:
+        results.append(place_id(id))
 
+    if with_scores:
+        return results, scores[offset:]
     return results
 
 
-def cosine_search(query: str) -> list:
+def bm25_term_frequency(names: np.array, descriptions: np.array, lengths: dict, averages: dict, k1: float, b: float, boosts: dict) -> np.array:
+    """Calculates the BM25F term frequency of a word on some places out of its count on each field
+
+    Args:
+        names (np.array): The count of the word on the name of each place
+        descriptions (np.array): The count of the word on the description of each place
+        lengths (dict): The length of each field on each place
+        averages (dict): The average length of each field on all places
+        k1 (float): The saturation of the term frequency
+        b (float): How much the length of the fields normalizes the term frequency
+        boosts (dict): The weight of each field
+
+    Returns:
+        np.array: The saturated term frequency of the word on each place
+    """
+    tf = np.zeros(len(names))
+    for field, counts in (("name", names), ("description", descriptions)):
+        tf += boosts[field] * counts / (1 - b + b * lengths[field] / averages[field])
+
+    return tf * (k1 + 1) / (k1 + tf)
+
+
+def bm25_search(query: str, k: int = 10, offset: int = 0, k1: float = BM25_K1, b: float = BM25_B, boosts: dict = None, filters: dict = None, with_scores: bool = False, with_facets: bool = False) -> list:
+    """Performs search on all places ranking them with BM25F. Name and description are scored as separate fields,
+        each one normalized by its own length, out of the word counts stored on the index, so the parameters can
+        change on each query without rebuilding anything. Only the places on the posting lists of the words of
+        the query are scored
+
+    Args:
+        query (str): The text introduced by the user
+        k (int): The number of places to return
+        offset (int): The number of best places to skip, to get the next pages of results
+        k1 (float): The saturation of the term frequency
+        b (float): How much the length of the fields normalizes the term frequency, between 0 and 1
+        boosts (dict): The weight of the "name" and "description" fields, BM25_BOOSTS is used for missing ones
+        filters (dict): Only places that pass these filters are returned (see filter_rows)
+        with_scores (bool): If the score of each place should be returned too
+        with_facets (bool): If the facet counts of all places that match the query should be returned too
+
+    Returns:
+        list: The top k places that match that query (after the offset given)
+        tuple: The list of places followed by the list of their scores and the facet counts (see facet_counts),
+            if with_scores or with_facets are True
+    """
+    global N, VOCABULARY, NAME_POSTINGS, DESCRIPTION_POSTINGS, FIELD_LENGTHS, DELETED
+
+    boosts = {**BM25_BOOSTS, **(boosts or {})}
+
+    # Preprocess the query
+    tokens = set(preprocess_query(query))
+
+    with INDEX_LOCK:
+        # Correct misspelled words and keep only words that appear on some place
+        terms = [VOCABULARY.get(token) for token in set(correct_tokens(tokens)) if token in VOCABULARY]
+
+        # Places with more of the query words get higher scores, rare words count more
+        df = VOCABULARY.df[terms].astype(np.float64)
+        idf = np.log(1 + (VOCABULARY.n_documents - df + 0.5) / (df + 0.5))
+        averages = average_lengths()
+
+        # Places on the delta segment are always few, so all of them are scored
+        names, descriptions = delta_counts()
+        lengths = {"name": np.asarray(names.sum(axis=1)).ravel(), "description": np.asarray(descriptions.sum(axis=1)).ravel()}
+        delta_scores = np.zeros(names.shape[0])
+        for term, weight in zip(terms, idf):
+            delta_scores += weight * bm25_term_frequency(names[:, term].toarray().ravel(), descriptions[:, term].toarray().ravel(), lengths, averages, k1, b, boosts)
+
+        rows = [np.flatnonzero(delta_scores) + N]
+        scores = [delta_scores[rows[0] - N]]
+
+        # Places that do not pass the filters are skipped
+        allowed = filter_rows(**(filters or {}))
+        if allowed is not None:
+            rows[0] = rows[0][allowed[rows[0]]]
+            scores[0] = delta_scores[rows[0] - N]
+
+        # Places on the base segment are scored only on the posting lists of each word
+        for term, weight in zip(terms, idf):
+            if term >= NAME_POSTINGS.shape[1]:
+                continue
+
+            names = NAME_POSTINGS[:, term]
+            descriptions = DESCRIPTION_POSTINGS[:, term]
+            places = np.union1d(names.indices, descriptions.indices)
+            places = places[~DELETED[places] if allowed is None else allowed[places]]
+            lengths = {field: values[places] for field, values in FIELD_LENGTHS.items()}
+
+            rows.append(places)
+            scores.append(weight * bm25_term_frequency(names[places].toarray().ravel(), descriptions[places].toarray().ravel(), lengths, averages, k1, b, boosts))
+
+        # Add up the score of each word on each place
+        rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse.ravel(), weights=np.concatenate(scores), minlength=len(rows))
+
+        # Select only the places up to the page requested
+        out = top_k(scores, k=offset + k)[offset:]
+        places = [place_id(rows[x]) for x in out]
+
+        results = (places,)
+        if with_scores:
+            results += ([float(scores[x]) for x in out],)
+        if with_facets:
+            results += (facet_counts(rows),)
+        return results if len(results) > 1 else places
+
+
+def query_matrix(queries: list) -> sparse.csr_matrix:
+    """Creates the normalized tf-idf vectors of many queries that were already preprocessed
+
+    Args:
+        queries (list): The tokens of each query
+
+    Returns:
+        sparse.csr_matrix: The L2-normalized tf-idf vector of each query (rows)
+    """
+    global VOCABULARY
+
+    # Words that are not on any place are left out
+    queries = [[token for token in tokens if token in VOCABULARY] for tokens in queries]
+    counts = count_matrix(queries, VOCABULARY)
+
+    # tf-idf = (word count / vocabulary size) * idf of the word
+    return normalize_rows(counts @ sparse.diags(VOCABULARY.idf / len(VOCABULARY)))
+
+
+def cosine_scores(vectors: sparse.csr_matrix) -> np.array:
+    """Calculates the cosine similarity of some queries to every place. Products are made with the index on its
+        own layout (places as rows), so it is never converted, and a single query is scored as a dense vector
+
+    Args:
+        vectors (sparse.csr_matrix): The normalized tf-idf vector of each query (rows), see query_matrix
+
+    Returns:
+        np.array: The similarity of each query (rows) to each place (columns, see place_id), -inf for removed places
+    """
+    global MATRIX, DELETED
+
+    with INDEX_LOCK:
+        # Words added after the last merge are only on the delta segment
+        delta = normalize_rows(delta_weights())
+        if vectors.shape[0] == 1:
+            vector = vectors.toarray().ravel()
+            scores = np.concatenate((MATRIX @ vector[:MATRIX.shape[1]], delta @ vector))[None, :]
+        else:
+            scores = sparse.vstack((MATRIX @ vectors[:, :MATRIX.shape[1]].T, delta @ vectors.T)).tocsc().T.toarray()
+
+        scores[:, np.flatnonzero(DELETED)] = -np.inf
+        return scores
+
+
+def batch_cosine_search(queries: list, k: int = 10, offset: int = 0, filters: dict = None, with_scores: bool = False, with_facets: bool = False) -> list:
+    """Performs search of many queries at once, scoring all of them against all places with a single sparse
+        matrix product
+
+    Args:
+        queries (list): The texts introduced by the user
+        k (int): The number of places to return for each query
+        offset (int): The number of best places to skip, to get the next pages of results
+        filters (dict): Only places that pass these filters are returned (see filter_rows)
+        with_scores (bool): If the score of each place should be returned too
+        with_facets (bool): If the facet counts of all places that match each query should be returned too
+
+    Returns:
+        list: The top k places that match each query (after the offset given)
+        list: A tuple with the list of places followed by the list of their scores and the facet counts
+            (see facet_counts) for each query, if with_scores or with_facets are True
+    """
+    # Preprocess the queries
+    tokens = [preprocess_query(query) for query in queries]
+
+    with INDEX_LOCK:
+        vectors = query_matrix([correct_tokens(x) for x in tokens])
+
+        # Calculate cosine similarity of every query to every place's vector at once
+        scores = cosine_scores(vectors)
+
+        # Places that do not pass the filters are skipped the same as removed places
+        allowed = filter_rows(**(filters or {}))
+        if allowed is not None:
+            scores[:, ~allowed] = -np.inf
+
+        # Select only the places up to the page requested of each query
+        results = []
+        for row in scores:
+            out = [x for x in top_k(row, k=offset + k)[offset:] if row[x] > -np.inf]
+            places = [place_id(x) for x in out]
+
+            result = (places,)
+            if with_scores:
+                result += ([float(row[x]) for x in out],)
+            if with_facets:
+                result += (facet_counts(np.flatnonzero(row > 0)),)
+            results.append(result if len(result) > 1 else places)
+
+        return results
+
+
+def cosine_search(query: str, k: int = 10, offset: int = 0, filters: dict = None, with_scores: bool = False, with_facets: bool = False) -> list:
     """Performs search on all places using the cosine similarity algorithm along with tf-idf algorithm
 
     Args:
         query (str): The text introduced by the user
+        k (int): The number of places to return
+        offset (int): The number of best places to skip, to get the next pages of results
+        filters (dict): Only places that pass these filters are returned (see filter_rows)
+        with_scores (bool): If the score of each place should be returned too
+        with_facets (bool): If the facet counts of all places that match the query should be returned too
 
     Returns:
-        list: The top 10 places that match that query
+        list: The top k places that match that query (after the offset given)
+        tuple: The list of places followed by the list of their scores and the facet counts (see facet_counts),
+            if with_scores or with_facets are True
     """
-    global DATAFRAME
+    return batch_cosine_search([query], k=k, offset=offset, filters=filters, with_scores=with_scores, with_facets=with_facets)[0]
 
-    # Create list to store cosine similarity results
-    d_cosines = []
 
-    # Create vector out of query sentence
-    query_vector = gen_vector(query)
+def ann_search(query: str, k: int = 10, offset: int = 0, probes: int = ANN_PROBES, filters: dict = None, with_scores: bool = False, with_facets: bool = False) -> list:
+    """Performs approximate search using the cosine similarity algorithm along with tf-idf algorithm. Only the
+        places grouped around the centroids closest to the query are scored (exactly), so it takes time proportional
+        to the number of groups probed instead of to the number of places. Places on the delta segment are all scored
 
-    # Calculate cosine similarity of query vector to each place's vector
-    for _, row in DATAFRAME.iterrows():
-        d_cosines.append(cosine_similarity(np.array(query_vector), np.array(row)))
+    Args:
+        query (str): The text introduced by the user
+        k (int): The number of places to return
+        offset (int): The number of best places to skip, to get the next pages of results
+        probes (int): The number of groups of places scored, more groups find more of the best places but take longer
+        filters (dict): Only places that pass these filters are returned (see filter_rows)
+        with_scores (bool): If the score of each place should be returned too
+        with_facets (bool): If the facet counts of the places scored that match the query should be returned too
 
-    # Get top 10 similar places
-    out = np.array(d_cosines).argsort()
-    out = out[::-1][:10]
+    Returns:
+        list: The top k places found that match that query (after the offset given)
+        tuple: The list of places followed by the list of their scores and the facet counts (see facet_counts),
+            if with_scores or with_facets are True
+    """
+    global N, MATRIX, ANN, DELETED
 
-    return [DATAFRAME.index[x] for x in out]
+    # Preprocess the query
+    tokens = preprocess_query(query)
+
+    with INDEX_LOCK:
+        vector = query_matrix([correct_tokens(tokens)])
+
+        # Score only the places of the closest groups, and all places of the delta segment
+        rows = ANN.candidates(vector, probes)
+        rows = rows[~DELETED[rows]]
+        scores = (MATRIX[rows] @ vector[:, :MATRIX.shape[1]].T).toarray().ravel()
+        delta_scores = (normalize_rows(delta_weights()) @ vector.T).toarray().ravel()
+        rows = np.concatenate((rows, np.arange(len(delta_scores)) + N))
+        scores = np.concatenate((scores, delta_scores))
+
+        # Places that do not pass the filters are skipped
+        allowed = filter_rows(**(filters or {}))
+        if allowed is not None:
+            rows, scores = rows[allowed[rows]], scores[allowed[rows]]
+
+        # Select only the places up to the page requested
+        out = top_k(scores, k=offset + k)[offset:]
+        places = [place_id(rows[x]) for x in out]
+
+        results = (places,)
+        if with_scores:
+            results += ([float(scores[x]) for x in out],)
+        if with_facets:
+            results += (facet_counts(rows[scores > 0]),)
+        return results if len(results) > 1 else places
+
+
+if __name__ == "__main__":
+    # Build the index offline and save it so the server can load it at startup, along with its shards if there are
+    places = read_all_places()
+    build_index(places, workers=BUILD_WORKERS)
+    save_index()
+
+    if SHARDS > 1:
+        build_shards(places, n_shards=SHARDS, workers=BUILD_WORKERS)
+
+elif __name__ != "__mp_main__" and (not SHARDED or "SEARCH_SHARD" in os.environ):
+    # Load the index at startup (worker processes started by build_index do not need it, and when the index is
+    # sharded the server leaves it to the shard servers, loading it only if it needs it with open_index)
+    open_index()
@@ -0,0 +1,34 @@
+import unittest
+
+import numpy as np
+
+from ml.fuzzy import TrigramIndex, edit_distance
+
+
+class TrigramIndexTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.index = TrigramIndex(["taco", "bar", "pizza", "sushi", "burger", "bat"])
+
+    def test_short_transpositions_are_corrected(self) -> None:
+        for typo, word in [("tcao", "taco"), ("atco", "taco"), ("taoc", "taco"), ("bra", "bar"), ("abr", "bar")]:
+            self.assertEqual(edit_distance(typo, word, 1), 1)
+            self.assertEqual([self.index.terms[i] for i in self.index.correct(typo, max_distance=1)], [word])
+
+    def test_two_transpositions_are_corrected(self) -> None:
+        self.assertEqual([self.index.terms[i] for i in self.index.correct("tcoa", max_distance=2)], ["taco"])
+
+    def test_words_too_far_are_not_corrected(self) -> None:
+        self.assertEqual(self.index.correct("ocat", max_distance=1), [])
+
+    def test_words_added_are_corrected(self) -> None:
+        self.index.add(["nachos"])
+        self.assertEqual([self.index.terms[i] for i in self.index.correct("ncahos", max_distance=1)], ["nachos"])
+
+    def test_scores_skip_words(self) -> None:
+        scores = np.array([0, 1, 1, 1, 1, 1])
+        self.assertEqual(self.index.correct("tcao", max_distance=1, scores=scores), [])
+
+
+if __name__ == "__main__":
+    unittest.main()